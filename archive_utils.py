@@ -0,0 +1,164 @@
+import os
+import logging
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+import pymongo
+from layout_utils import COMMON_FIELDS, compact_document, expand_document
+
+logger = logging.getLogger('main.archive')
+
+# Old readings are moved from MongoDB to Parquet files, one per day or month of the station timestamp:
+#     <path>/readings_YYYY-MM-DD.parquet or <path>/readings_YYYY-MM.parquet
+# with a column for the timestamp, the insertion time, the _id and each parameter (short key of the
+# compact layout). Readings without a valid timestamp are not archived.
+
+PARTITION_FORMATS = {'day': '%Y-%m-%d', 'month': '%Y-%m'}
+
+
+def partition_start(timestamp, partition):
+    """
+    Get the start of the partition (day or month) of a timestamp.
+    """
+    start = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    return start.replace(day=1) if partition == 'month' else start
+
+
+def next_partition(start, partition):
+    """
+    Get the start of the partition after the given one.
+    """
+    if partition == 'month':
+        return (start + timedelta(days=32)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def partition_path(path, start, partition):
+    """
+    Get the file of a partition.
+    """
+    return os.path.join(path, f"readings_{start.strftime(PARTITION_FORMATS[partition])}.parquet")
+
+
+def to_dataframe(documents):
+    """
+    Convert the documents of the readings, in either layout, to a DataFrame with one column per parameter.
+    Numeric parameters are stored as floats, the others (Date, Time, ...) as strings.
+    """
+    df = pd.DataFrame([compact_document(doc) for doc in documents])
+    df['_id'] = df['_id'].astype(str)
+    df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
+    df['added'] = pd.to_datetime(df['added'], utc=True)
+    for column in df.columns:
+        if column in COMMON_FIELDS:
+            continue
+        values = df[column].dropna()
+        if values.map(lambda v: isinstance(v, (int, float)) and not isinstance(v, bool)).all():
+            df[column] = df[column].astype(float)
+        else:
+            df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+    return df
+
+
+def write_partition(df, filename):
+    """
+    Write the readings of a partition, merging them with the ones already in the file, if any, without
+    the duplicates (same timestamp and added). The file is replaced only once completely written.
+    Returns:
+        Number of readings in the file.
+    """
+    if os.path.exists(filename):
+        df = pd.concat([pd.read_parquet(filename), df], ignore_index=True)
+    # a reading stored twice, in the file or in MongoDB, is archived once
+    df = df.drop_duplicates(subset=['timestamp', 'added'], keep='first')
+    df = df.sort_values('timestamp', ignore_index=True)
+    temp = filename + '.tmp'
+    df.to_parquet(temp, compression='zstd', index=False)
+    os.replace(temp, filename)
+    return len(df)
+
+
+def archive_readings(collection, path, max_age_days, partition='day', batch_size=1000):
+    """
+    Move the readings older than max_age_days from the collection to the Parquet files.
+    Only complete partitions are moved. Each partition is deleted from MongoDB after its file has been
+    written, so if the job is stopped it can be run again without losing or duplicating readings.
+    Args:
+        collection: Collection of the readings.
+        path: Folder of the Parquet files.
+        max_age_days: Age in days of the station timestamp after which the readings are archived.
+        partition: 'day' or 'month', period of the readings stored in each file.
+        batch_size: Number of readings deleted with each request.
+    Returns:
+        Number of readings archived.
+    """
+    os.makedirs(path, exist_ok=True)
+    cutoff = partition_start(datetime.now(timezone.utc) - timedelta(days=max_age_days), partition)
+    oldest = collection.find_one({'timestamp': {'$type': 'date'}}, {'timestamp': 1},
+                                 sort=[('timestamp', pymongo.ASCENDING)])
+    if oldest is None:
+        return 0
+    start = partition_start(oldest['timestamp'].replace(tzinfo=timezone.utc), partition)
+    archived = 0
+    while start < cutoff:
+        end = next_partition(start, partition)
+        documents = list(collection.find({'timestamp': {'$gte': start, '$lt': end}}))
+        if documents:
+            filename = partition_path(path, start, partition)
+            rows = write_partition(to_dataframe(documents), filename)
+            ids = [doc['_id'] for doc in documents]
+            for i in range(0, len(ids), batch_size):
+                collection.delete_many({'_id': {'$in': ids[i:i + batch_size]}})
+            archived += len(documents)
+            logger.info(f"### {len(documents)} readings archived to {filename} ({rows} in the file)")
+        start = end
+    logger.info(f"### {archived} readings older than {cutoff:%Y-%m-%d} archived")
+    return archived
+
+
+def read_archive(path, start, end, partition='day'):
+    """
+    Read the archived readings of a time range.
+    Args:
+        path: Folder of the Parquet files.
+        start: Start of the range (UTC datetime).
+        end: End of the range (UTC datetime).
+        partition: 'day' or 'month', as used for the archival.
+    Returns:
+        DataFrame with the readings, sorted by timestamp, empty if there are none.
+    """
+    frames = []
+    current = partition_start(start, partition)
+    while current <= end:
+        filename = partition_path(path, current, partition)
+        if os.path.exists(filename):
+            df = pd.read_parquet(filename, filters=[('timestamp', '>=', pd.Timestamp(start)),
+                                                    ('timestamp', '<=', pd.Timestamp(end))])
+            frames.append(df)
+        current = next_partition(current, partition)
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True).sort_values('timestamp', ignore_index=True)
+
+
+def find_readings(collection, path, start, end, partition='day'):
+    """
+    Get the readings of a time range from both the archive and MongoDB, in the legacy layout
+    {name: {'value': v}}, sorted by timestamp.
+    Args:
+        collection: Collection of the readings.
+        path: Folder of the Parquet files, None if there is no archive.
+        start: Start of the range (UTC datetime).
+        end: End of the range (UTC datetime).
+        partition: 'day' or 'month', as used for the archival.
+    Returns:
+        Generator of the documents.
+    """
+    if path:
+        for row in read_archive(path, start, end, partition).to_dict('records'):
+            row['timestamp'] = row['timestamp'].to_pydatetime()
+            row['added'] = row['added'].to_pydatetime()
+            # drop the parameters missing in the reading
+            yield expand_document({key: value for key, value in row.items() if not pd.isna(value)})
+    query = {'timestamp': {'$gte': start, '$lte': end}}
+    for doc in collection.find(query, sort=[('timestamp', pymongo.ASCENDING)]):
+        yield expand_document(doc)
@@ -0,0 +1,170 @@
+import logging
+from datetime import timezone
+import numpy as np
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from layout_utils import COMPACT_KEYS, expand_document
+
+logger = logging.getLogger('main.buckets')
+
+# Bucket documents hold the readings of one hour of the station:
+# {
+#     "_id": datetime of the start of the hour (UTC),
+#     "count": number of readings,
+#     "end": timestamp of the last reading,
+#     "timestamps": [timestamp of each reading],
+#     "values": {short key: [value of each reading]},
+#     "summary": {short key: {"min": v, "max": v}},
+# }
+# The values of each parameter are parallel to the timestamps; missing values are stored as None.
+
+
+def bucket_start(timestamp):
+    """
+    Get the start of the hour of a timestamp, used as _id of its bucket.
+    """
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def bucket_update(doc, names=()):
+    """
+    Create the update appending a reading to its bucket.
+    If the timestamp is already in the bucket, the filter does not match and the upsert fails with a
+    duplicate key, so that a reading written twice is not appended twice.
+    Args:
+        doc: Document of the reading, in either layout.
+        names: Names of the parameters of the Header collection, pushed as None if the reading lacks them.
+    Returns:
+        The UpdateOne request, or None if the reading has no timestamp.
+    """
+    timestamp = doc.get('timestamp')
+    if timestamp is None:
+        return None
+    push = {'timestamps': timestamp}
+    minimum = {}
+    maximum = {'end': timestamp}
+    reading = expand_document(doc)
+    # every known parameter is pushed, even if missing, to keep the arrays parallel to the timestamps
+    known = dict.fromkeys([*COMPACT_KEYS, *names])
+    for name in [*known, *[name for name in reading if name not in known]]:
+        value = reading.get(name)
+        if not isinstance(value, dict):
+            if name not in known:
+                continue
+            value = {}
+        value = value.get('value')
+        key = COMPACT_KEYS.get(name, name)
+        push['values.' + key] = value
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            minimum['summary.' + key + '.min'] = value
+            maximum['summary.' + key + '.max'] = value
+    update = {'$push': push, '$inc': {'count': 1}, '$max': maximum}
+    if minimum:
+        update['$min'] = minimum
+    return UpdateOne({'_id': bucket_start(timestamp), 'timestamps': {'$ne': timestamp}}, update, upsert=True)
+
+
+def write_new_readings(collection, requests):
+    """
+    Execute the upserts adding readings to their summary documents (buckets or rollups), in order,
+    skipping the readings already added, whose upsert fails with a duplicate key.
+    Args:
+        collection: Collection of the summary documents.
+        requests: UpdateOne requests, as given by bucket_update or rollup_utils.rollup_update.
+    """
+    while requests:
+        try:
+            # ordered, so that the readings are appended in the order they arrived
+            collection.bulk_write(requests, ordered=True)
+            break
+        except BulkWriteError as err:
+            error = err.details['writeErrors'][0]
+            # 11000: duplicate key, the reading is already in its bucket/rollup
+            if error['code'] != 11000:
+                raise
+            logger.debug(f"Reading already in {collection.name}, skipped")
+            # the requests after the failed one were not executed
+            requests = requests[error['index'] + 1:]
+
+
+def append_to_buckets(collection, documents, names=()):
+    """
+    Append the readings to their hourly buckets with a single request.
+    Args:
+        collection: Collection of the buckets.
+        documents: Documents of the readings, in either layout.
+        names: Names of the parameters of the Header collection, see bucket_update.
+    """
+    write_new_readings(collection, [request for request in (bucket_update(doc, names) for doc in documents)
+                                    if request is not None])
+
+
+def to_array(values):
+    """
+    Convert a list of values to a NumPy array, float with NaN for the missing values if possible.
+    """
+    try:
+        return np.array(values, dtype=float)
+    except (TypeError, ValueError):
+        return np.array(values, dtype=object)
+
+
+def read_buckets(collection, start, end, names):
+    """
+    Read the readings of a time range from the hourly buckets.
+    Args:
+        collection: Collection of the buckets.
+        start: Start of the range (UTC datetime).
+        end: End of the range (UTC datetime).
+        names: Names of the parameters, e.g. 'Air Temperature'.
+    Returns:
+        Tuple with the array of timestamps (datetime64[ms], UTC) and a dictionary with the array of
+        values of each parameter, sorted by time.
+    """
+    keys = {name: COMPACT_KEYS.get(name, name) for name in names}
+    projection = {'timestamps': 1}
+    for key in keys.values():
+        projection['values.' + key] = 1
+    cursor = collection.find({'_id': {'$gte': bucket_start(start), '$lte': end}}, projection, sort=[('_id', 1)])
+    timestamps = []
+    values = {name: [] for name in names}
+    for bucket in cursor:
+        count = len(bucket['timestamps'])
+        timestamps.extend(bucket['timestamps'])
+        for name, key in keys.items():
+            column = bucket.get('values', {}).get(key, [])
+            # a new parameter added in the middle of the bucket has less values than timestamps
+            values[name].extend([None] * (count - len(column)) + column)
+    times = np.array([t.replace(tzinfo=None) if t.tzinfo is None else t.astimezone(timezone.utc).replace(tzinfo=None)
+                      for t in timestamps], dtype='datetime64[ms]')
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    mask = (times >= np.datetime64(start.replace(tzinfo=None), 'ms')) & (times <= np.datetime64(end.replace(tzinfo=None), 'ms'))
+    return times[mask], {name: to_array(column)[order][mask] for name, column in values.items()}
+
+
+def read_bucket_summaries(collection, start, end, names):
+    """
+    Read the hourly min/max/count of the parameters, without unpacking the readings.
+    Args:
+        collection: Collection of the buckets.
+        start: Start of the range (UTC datetime).
+        end: End of the range (UTC datetime).
+        names: Names of the parameters, e.g. 'Air Temperature'.
+    Returns:
+        Tuple with the array of the start of each hour, the array of the number of readings in each hour
+        and a dictionary with the arrays of min and max of each parameter.
+    """
+    keys = {name: COMPACT_KEYS.get(name, name) for name in names}
+    projection = {'count': 1}
+    for key in keys.values():
+        projection['summary.' + key] = 1
+    buckets = list(collection.find({'_id': {'$gte': bucket_start(start), '$lte': end}}, projection, sort=[('_id', 1)]))
+    hours = np.array([bucket['_id'].replace(tzinfo=None) for bucket in buckets], dtype='datetime64[ms]')
+    counts = np.array([bucket.get('count', 0) for bucket in buckets], dtype=int)
+    summaries = {}
+    for name, key in keys.items():
+        summary = [bucket.get('summary', {}).get(key, {}) for bucket in buckets]
+        summaries[name] = {'min': to_array([s.get('min') for s in summary]),
+                           'max': to_array([s.get('max') for s in summary])}
+    return hours, counts, summaries
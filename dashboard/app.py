@@ -1,6 +1,5 @@
 import matplotlib
 import pandas as pd
-from pandas import json_normalize
 import flask
 import logging
 from logging.handlers import TimedRotatingFileHandler
@@ -20,18 +19,26 @@ from dotenv import load_dotenv
 from waitress import serve
 import uuid
 import itertools
+import sys
+# modules shared with the WS client, in the root folder of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 from utils_functions import (convert_meteorological_deg2cardinal_dir,
-                             combine_datetime, get_magic_values,
+                             get_magic_values,
                              get_tng_dust_value, toggle_modal,
-                             get_value_or_nan, handle_data_gaps)
+                             get_value_or_nan, handle_data_gaps,
+                             graph_state, extend_graph, downsample)
 from configurations import (location_lst, spd_colors_speed,
                             precipitationtype_dict, alert_states_default,
-                            rain_alert_timer, min_alert_interval)
+                            rain_alert_timer, min_alert_interval, time_options,
+                            max_graph_points)
 from sidebar import sidebar, create_list_group_item, create_list_group_item_alert
 from content import (content, dir_bins, dir_labels, spd_bins, spd_labels,
                      alert_messages, satellite_tab, cloud_tab, thunder_tab,
                      rain_tab)
 from navbar import navbar
+from layout_utils import expand_document  # noqa: E402
+from index_utils import ensure_indexes_safe  # noqa: E402
+from readings_cache import ReadingsCache  # noqa: E402
 
 
 matplotlib.use('Agg')
@@ -63,10 +70,19 @@ try:
     client = MongoClient("mongodb://" + db_host + ":" + db_port)
     mydb = client[db_name]
     collection = mydb[db_coll]
+    ensure_indexes_safe(collection, 'readings')
 except Exception:
     logger.exception("Failed to connect to MongoDB.")
 
 
+# Readings of the graphs, fetched once for all the callbacks and all the sessions
+readings_cache = ReadingsCache(collection,
+                               ['Air Temperature', 'Dew Point Temperature', 'Relative Humidity',
+                                'Average Wind Speed', 'Max Wind', 'Mean 10 Wind Speed', 'Mean Wind Direction',
+                                'Global Radiation'],
+                               window=max(option['value'] for option in time_options))
+
+
 # Instantiate Dash and Exposing the Flask Server
 # meta_tags arguments allow controlling the size of the app component through different devices size
 FONT_AWESOME = "https://use.fontawesome.com/releases/v5.10.2/css/all.css"
@@ -189,42 +205,18 @@ def update_sun(n_intervals):
               [Input('interval-livevalues', 'n_intervals')],
               [State('alert-store', 'data'),
                State('rain-store', 'data')])
-def update_live_values(n_intervals, alert_states_store, rain_timer, n=100):
+def update_live_values(n_intervals, alert_states_store, rain_timer):
     alert_states = alert_states_store
     rain_alert_timer = rain_timer
-    # Get the latest reading from the database
+    # Get the latest reading with a valid WS timestamp from the database
     time_now = datetime.now(timezone.utc)
-    latest_data = collection.find_one(sort=[('added', pymongo.DESCENDING)])
+    latest_data = expand_document(collection.find_one({'timestamp': {'$type': 'date'}}, sort=[('timestamp', pymongo.DESCENDING)]))
+    if latest_data is None:
+        raise Exception("Unable to find a valid timestamp in the database.")
     cloud_value, tran9_value = get_magic_values()
     tng_dust_value = get_tng_dust_value()
     # Get the WS timestamps
-    time = latest_data['Time']['value']
-    date = latest_data['Date']['value']
-    try:
-        dt_str = date + ' ' + time
-        timestamps = datetime.strptime(dt_str, '%Y%m%d %H%M%S').replace(tzinfo=timezone.utc)
-    except Exception as e:
-        # if an exception is raised, try to get the second-to-last entry in the database
-        logger.warning(f'Error in timestamp entry: {e}. MongoDb ID: {latest_data["_id"]}')
-        logger.warning('Checking the second-to-last entry in the database.')
-        latest_data = collection.find_one(sort=[('added', pymongo.DESCENDING)], skip=1)
-        time = latest_data['Time']['value']
-        date = latest_data['Date']['value']
-        i = 2  # start with the third-to-last entry
-        while True:
-            try:
-                dt_str = date + ' ' + time
-                timestamps = datetime.strptime(dt_str, '%Y%m%d %H%M%S')
-                break  # exit the loop if a valid timestamp is found
-            except Exception as e:
-                logger.error(f'Error in timestamp entry: {e}. MongoDb ID: {latest_data["_id"]}')
-                logger.warning(f'Checking the {i}-to-last entry in the database.')
-                latest_data = collection.find_one(sort=[('added', pymongo.DESCENDING)], skip=i)
-                time = latest_data['Time']['value']
-                date = latest_data['Date']['value']
-                i += 1  # move to the next entry in the database
-                if i > n:  # exit the loop if all entries have been checked
-                    raise Exception("Unable to find a valid timestamp in the database.")
+    timestamps = latest_data['timestamp'].replace(tzinfo=timezone.utc)
 
     # Control the values, if they can not be accessed, put n/a
     temp = get_value_or_nan(latest_data, 'Air Temperature')
@@ -400,43 +392,34 @@ def play_audio(audio_triggers):
 
 # callback  to update the temp graph
 @app.callback([Output('temp-graph', 'figure'),
+               Output('temp-graph', 'extendData'),
+               Output('temp-graph-state', 'data'),
                Output('temp-timestamp', 'children')],
               [Input('interval-component', 'n_intervals'),
                Input('temp_hour_choice', 'value'),
-               Input('Temperature-refresh-button', 'n_clicks')])
-def update_temp_graph(n_intervals, time_range, refresh_clicks):
-    # Define the projection to query only the required fields
-    projection = {
-        'added': 1,
-        'Air Temperature.value': 1,
-        'Dew Point Temperature.value': 1,
-        'Time.value': 1,
-        'Date.value': 1,
-        '_id': 0
-    }
+               Input('Temperature-refresh-button', 'n_clicks')],
+              State('temp-graph-state', 'data'))
+def update_temp_graph(n_intervals, time_range, refresh_clicks, state):
     utc_now = datetime.now(timezone.utc)
-    data = list(collection.find({'added': {'$gte': utc_now - timedelta(hours=time_range)}},
-                                projection, sort=[('added', pymongo.DESCENDING)]))
-
-    if not data:
-        # Query the latest data from the database
-        last = collection.find_one({},
-                                   projection,
-                                   sort=[('added', pymongo.DESCENDING)]
-                                   )
-        if last:
-            # Retrieve all the data starting from the latest data
-            data = list(collection.find({'added': {'$gte': last['added'] - timedelta(hours=time_range)}},
-                                        projection, sort=[('added', pymongo.DESCENDING)]))
-    # Get the temperature values and the dew-point values
-    temps = [d['Air Temperature']['value'] for d in data]
-    dews = [d['Dew Point Temperature']['value'] for d in data]
-    # create a list of tuple and get WS timestamps
-    date_time = [(doc['Date']['value'], doc['Time']['value']) for doc in data]
-    timestamps = combine_datetime(date_time)
+    # Get the WS timestamps, the temperature values and the dew-point values, newest first
+    timestamps, data = readings_cache.get(['Air Temperature', 'Dew Point Temperature'], time_range)
+    temps = data['Air Temperature']
+    dews = data['Dew Point Temperature']
+    badge = dbc.Badge(f"Last update: {timestamps[0]}", color='secondary' if timestamps[0].replace(tzinfo=timezone.utc) < (utc_now - timedelta(minutes=5)) else 'green')
+
+    # At each interval only the new points are sent
+    if 'interval-component' in dash.callback_context.triggered[0]['prop_id']:
+        extension, state = extend_graph(state, time_range, timestamps, temps, dews)
+        if extension is not None:
+            return dash.no_update, extension or dash.no_update, state, badge
 
     # correct for data missing for >2min so that no line in connecting the dots is shown in that case
-    new_timestamps, new_temps, new_dews = handle_data_gaps(timestamps, temps, dews)
+    # the traces go from the oldest point, so that the new ones can be appended
+    new_timestamps, new_temps, new_dews = handle_data_gaps(timestamps[::-1], temps[::-1], dews[::-1])
+    # for the long time ranges plot only the min and max of each interval
+    n_points = len(new_timestamps)
+    new_timestamps, new_temps, new_dews = downsample(time_range, new_timestamps, new_temps, new_dews, max_points=max_graph_points)
+    downsampled = len(new_timestamps) < n_points
 
     fig = go.Figure()
     fig.add_trace(go.Scatter(x=new_timestamps, y=new_temps,
@@ -475,45 +458,46 @@ def update_temp_graph(n_intervals, time_range, refresh_clicks):
     if button_id in ctx.triggered[0]['prop_id']:
         # Reset the zoom by setting 'uirevision' to a unique value
         fig.update_layout(uirevision=str(uuid.uuid4()))
-    return fig, dbc.Badge(f"Last update: {timestamps[0]}", color='secondary' if timestamps[0].replace(tzinfo=timezone.utc) < (utc_now - timedelta(minutes=5)) else 'green')
+    return fig, dash.no_update, graph_state(time_range, new_timestamps, downsampled=downsampled), badge
 
 
 # callback to update the humidity graph
 @app.callback([Output('humidity-graph', 'figure'),
+               Output('humidity-graph', 'extendData'),
+               Output('humidity-graph-state', 'data'),
                Output('hum-timestamp', 'children')],
               [Input('interval-component', 'n_intervals'),
                Input('hum_hour_choice', 'value'),
-               Input('Humidity-refresh-button', 'n_clicks')])
-def update_hum_graph(n_intervals, time_range, refresh_clicks):
-    projection = {
-        'added': 1,
-        'Relative Humidity.value': 1,
-        'Time': 1,
-        'Date': 1,
-        '_id': 0
-    }
+               Input('Humidity-refresh-button', 'n_clicks')],
+              State('humidity-graph-state', 'data'))
+def update_hum_graph(n_intervals, time_range, refresh_clicks, state):
     utc_now = datetime.now(timezone.utc)
-    data = list(collection.find({'added': {'$gte': utc_now - timedelta(hours=time_range)}},
-                                projection).sort('added', pymongo.DESCENDING))  # first value is the newest
-    if not data:
-        # Query the latest data from the database
-        last = collection.find_one({},
-                                   projection,
-                                   sort=[('added', pymongo.DESCENDING)]
-                                   )
-        if last:
-            # Retrieve all the data starting from the latest data
-            data = list(collection.find({'added': {'$gte': last['added'] - timedelta(hours=time_range)}},
-                                        projection, sort=[('added', pymongo.DESCENDING)]))
-
+    timestamps, data = readings_cache.get(['Relative Humidity'], time_range)  # first value is the newest
+    hums = data['Relative Humidity']
     # Get the most recent value
-    latest_data = data[0]['Relative Humidity']['value']
-    hums = [d['Relative Humidity']['value'] for d in data]
-    date_time = [(doc['Date']['value'], doc['Time']['value']) for doc in data]
-    timestamps = combine_datetime(date_time)
+    latest_data = hums[0]
+    badge = dbc.Badge(f"Last update: {timestamps[0]}", color='secondary' if timestamps[0].replace(tzinfo=timezone.utc) < (utc_now - timedelta(minutes=5)) else 'green')
+
+    # Graph color if above limit if timestamps are up to date
+    color = None
+    if timestamps[0].replace(tzinfo=timezone.utc) > (utc_now - timedelta(minutes=5)):
+        if latest_data >= 90:
+            color = 'red'
+        if 80 <= latest_data < 90:
+            color = 'orange'
+
+    # At each interval only the new points are sent, unless the color changed
+    if 'interval-component' in dash.callback_context.triggered[0]['prop_id']:
+        extension, state = extend_graph(state, time_range, timestamps, hums, style=[color])
+        if extension is not None:
+            return dash.no_update, extension or dash.no_update, state, badge
 
     # correct for data missing for >2min so that no line in connecting the dots in that case
-    new_timestamps, new_hums = handle_data_gaps(timestamps, hums)
+    new_timestamps, new_hums = handle_data_gaps(timestamps[::-1], hums[::-1])
+    # for the long time ranges plot only the min and max of each interval
+    n_points = len(new_timestamps)
+    new_timestamps, new_hums = downsample(time_range, new_timestamps, new_hums, max_points=max_graph_points)
+    downsampled = len(new_timestamps) < n_points
 
     fig = go.Figure()
     fig.add_trace(go.Scatter(x=new_timestamps, y=new_hums,
@@ -543,12 +527,9 @@ def update_hum_graph(n_intervals, time_range, refresh_clicks):
                       )
     fig.update_xaxes(showgrid=False)
 
-    # Change graph color if above limit if timestamps are up to date
-    if timestamps[0].replace(tzinfo=timezone.utc) > (utc_now - timedelta(minutes=5)):
-        if latest_data >= 90:
-            fig.update_traces(fill='tonexty', line_color='red')
-        if 80 <= latest_data < 90:
-            fig.update_traces(fill='tonexty', line_color='orange')
+    # Change graph color if above limit
+    if color:
+        fig.update_traces(fill='tonexty', line_color=color)
 
     # Check if the refresh button was clicked
     ctx = dash.callback_context
@@ -556,56 +537,47 @@ def update_hum_graph(n_intervals, time_range, refresh_clicks):
     if button_id in ctx.triggered[0]['prop_id']:
         # Reset the zoom by setting 'uirevision' to a unique value
         fig.update_layout(uirevision=str(uuid.uuid4()))
-    return fig, dbc.Badge(f"Last update: {timestamps[0]}", color='secondary' if timestamps[0].replace(tzinfo=timezone.utc) < (utc_now - timedelta(minutes=5)) else 'green')
+    return fig, dash.no_update, graph_state(time_range, new_timestamps, [color], downsampled), badge
 
 
 # callback to update the wind graph
 @app.callback([Output('wind-graph', 'figure'),
+               Output('wind-graph', 'extendData'),
+               Output('wind-graph-state', 'data'),
                Output('wind-timestamp', 'children')],
               [Input('interval-component', 'n_intervals'),
                Input('wind_hour_choice', 'value'),
-               Input('Wind Speed-refresh-button', 'n_clicks')])
-def update_wind_graph(n_intervals, time_range, refresh_clicks):
-    projection = {
-        'added': 1,
-        'Average Wind Speed.value': 1,
-        'Max Wind.value': 1,
-        'Mean 10 Wind Speed.value': 1,
-        'Time.value': 1,
-        'Date.value': 1,
-        '_id': 0
-    }
+               Input('Wind Speed-refresh-button', 'n_clicks')],
+              State('wind-graph-state', 'data'))
+def update_wind_graph(n_intervals, time_range, refresh_clicks, state):
     utc_now = datetime.now(timezone.utc)
-    # Query the data from the database
-    data = list(collection.find({'added': {'$gte': utc_now - timedelta(hours=time_range)}},
-                                projection).sort('added', pymongo.DESCENDING))  # first value is the newest
-    if not data:
-        # Query the latest data from the database
-        last = collection.find_one({},
-                                   projection,
-                                   sort=[('added', pymongo.DESCENDING)]
-                                   )
-        if last:
-            # Retrieve all the data starting from the latest data
-            data = list(collection.find({'added': {'$gte': last['added'] - timedelta(hours=time_range)}},
-                                        projection, sort=[('added', pymongo.DESCENDING)]))
-
-    fig = go.Figure()
+    # Get the timestamps of the WS and the wind and gusts values, first value is the newest
+    timestamps, data = readings_cache.get(['Average Wind Speed', 'Max Wind', 'Mean 10 Wind Speed'], time_range)
+    w_speed = data['Average Wind Speed']
+    w10_speed = data['Mean 10 Wind Speed']
+    g_speed = data['Max Wind']
+    badge = dbc.Badge(f"Last update: {timestamps[0]}", color='secondary' if timestamps[0].replace(tzinfo=timezone.utc) < (utc_now - timedelta(minutes=5)) else 'green')
 
     # Get the most recent value
-    # latest_wdata = data[0]['Average Wind Speed']['value']
-    latest_w10data = data[0]['Mean 10 Wind Speed']['value']
-    latest_gdata = data[0]['Max Wind']['value']
-    # Get the wind and gusts values
-    w_speed = [d.get('Average Wind Speed', {}).get('value') for d in data]
-    w10_speed = [d.get('Mean 10 Wind Speed', {}).get('value') for d in data]
-    g_speed = [d.get('Max Wind', {}).get('value') for d in data]
-    # Get the timestamps of the WS
-    date_time = [(doc['Date']['value'], doc['Time']['value']) for doc in data]
-    timestamps = combine_datetime(date_time)
+    # latest_wdata = w_speed[0]
+    latest_w10data = w10_speed[0]
+    latest_gdata = g_speed[0]
+    alerts = [bool(latest_gdata >= 60), bool(latest_w10data >= 36)]
+
+    # At each interval only the new points are sent (traces in the order of the figure), unless an alert changed
+    if 'interval-component' in dash.callback_context.triggered[0]['prop_id']:
+        extension, state = extend_graph(state, time_range, timestamps, w_speed, g_speed, w10_speed, style=alerts)
+        if extension is not None:
+            return dash.no_update, extension or dash.no_update, state, badge
+
+    fig = go.Figure()
 
     # correct for data missing for >2min so that no line in connecting the dots in that case
-    new_timestamps, new_w_speed, new_w10_speed, new_g_speed = handle_data_gaps(timestamps, w_speed, w10_speed, g_speed)
+    new_timestamps, new_w_speed, new_w10_speed, new_g_speed = handle_data_gaps(timestamps[::-1], w_speed[::-1], w10_speed[::-1], g_speed[::-1])
+    # for the long time ranges plot only the min and max of each interval, so that all the gust peaks are shown
+    n_points = len(new_timestamps)
+    new_timestamps, new_w_speed, new_w10_speed, new_g_speed = downsample(time_range, new_timestamps, new_w_speed, new_w10_speed, new_g_speed, max_points=max_graph_points)
+    downsampled = len(new_timestamps) < n_points
 
     # Wind 1' trace
     w_name = "Wind 1' Avg"
@@ -677,7 +649,7 @@ def update_wind_graph(n_intervals, time_range, refresh_clicks):
     if button_id in ctx.triggered[0]['prop_id']:
         # Reset the zoom by setting 'uirevision' to a unique value
         fig.update_layout(uirevision=str(uuid.uuid4()))
-    return fig, dbc.Badge(f"Last update: {timestamps[0]}", color='secondary' if timestamps[0].replace(tzinfo=timezone.utc) < (utc_now - timedelta(minutes=5)) else 'green')
+    return fig, dash.no_update, graph_state(time_range, new_timestamps, alerts, downsampled), badge
 
 #graph replace by windy map
 # callback to update the brightness graph
@@ -753,38 +725,11 @@ def update_wind_graph(n_intervals, time_range, refresh_clicks):
                Input('Wind Rose-refresh-button', 'n_clicks')]
               )
 def update_wind_rose(n_intervals, time_range, refresh_clicks):
-    # Fetch the wind data from the MongoDB database for the last x hours
-    projection = {
-        "_id": 0,
-        "added": 1,
-        "Mean 10 Wind Speed.value": 1,
-        "Mean Wind Direction.value": 1,
-        'Time.value': 1,
-        'Date.value': 1,
-    }
+    # Get the wind data and the WS timestamps of the last x hours
     utc_now = datetime.now(timezone.utc)
-    datapoints = list(collection.find({"added": {"$gte": utc_now - timedelta(hours=time_range)}},
-                                      projection, sort=[('added', pymongo.DESCENDING)]))
-
-    if not datapoints:
-        # Query the latest data from the database
-        last = collection.find_one({},
-                                   projection,
-                                   sort=[('added', pymongo.DESCENDING)]
-                                   )
-        if last:
-            # Retrieve all the data starting from the latest data
-            datapoints = list(collection.find({'added': {'$gte': last['added'] - timedelta(hours=time_range)}},
-                                              projection, sort=[('added', pymongo.DESCENDING)]))
-
-    wind_data = json_normalize(datapoints).rename(columns={'Mean 10 Wind Speed.value': 'WindSpd',
-                                                           'Mean Wind Direction.value': 'WindDir',
-                                                           })
-
-    # Get the WS timestamps
-    # using zip() to iterate over both the Date.value and Time.value columns of the pd db simultaneously
-    date_time_list = [(date, time) for date, time in zip(wind_data['Date.value'], wind_data['Time.value'])]
-    timestamps = combine_datetime(date_time_list)
+    timestamps, data = readings_cache.get(['Mean 10 Wind Speed', 'Mean Wind Direction'], time_range)
+    wind_data = pd.DataFrame({'WindSpd': data['Mean 10 Wind Speed'],
+                              'WindDir': data['Mean Wind Direction']})
 
     # Determine the total number of observations and how many have calm conditions
     total_count = wind_data.shape[0]
@@ -877,44 +822,36 @@ def update_wind_rose(n_intervals, time_range, refresh_clicks):
 
 # Define the callback function to update the radiation graph
 @app.callback([Output('radiation-graph', 'figure'),
+               Output('radiation-graph', 'extendData'),
+               Output('radiation-graph-state', 'data'),
                Output('rad-timestamp', 'children')],
               [Input('interval-component', 'n_intervals'),
                Input('rad_hour_choice', 'value'),
-               Input('Global Radiation-refresh-button', 'n_clicks')])
-def update_radiation_graph(n_intervals, time_range, refresh_clicks):
-    projection = {
-        'added': 1,
-        'Global Radiation.value': 1,
-        'Time.value': 1,
-        'Date.value': 1,
-        '_id': 0
-    }
+               Input('Global Radiation-refresh-button', 'n_clicks')],
+              State('radiation-graph-state', 'data'))
+def update_radiation_graph(n_intervals, time_range, refresh_clicks, state):
     utc_now = datetime.now(timezone.utc)
-    # Query the data from the database
-    data = list(collection.find({'added': {'$gte': utc_now - timedelta(hours=time_range)}},
-                                projection, sort=[('added', pymongo.DESCENDING)]))
-    if not data:
-        # Query the latest data from the database and avoid having None values
-        last = collection.find_one({},
-                                   projection,
-                                   sort=[('added', pymongo.DESCENDING)]
-                                   )
-        if last:
-            # Retrieve all the data starting from the latest data
-            data = list(collection.find({'added': {'$gte': last['added'] - timedelta(hours=time_range)}},
-                                        projection, sort=[('added', pymongo.DESCENDING)]))
-    # Get the global radiation values
-    rad = [d['Global Radiation']['value'] for d in data]
-    # Get the WS timestamps
-    date_time = [(doc['Date']['value'], doc['Time']['value']) for doc in data]
-    timestamps = combine_datetime(date_time)
+    # Get the WS timestamps and the global radiation values
+    timestamps, data = readings_cache.get(['Global Radiation'], time_range)
+    rad = data['Global Radiation']
+    badge = dbc.Badge(f"Last update: {timestamps[0]}", color='secondary' if timestamps[0].replace(tzinfo=timezone.utc) < (utc_now - timedelta(minutes=5)) else 'green')
+
+    # At each interval only the new points are sent
+    if 'interval-component' in dash.callback_context.triggered[0]['prop_id']:
+        extension, state = extend_graph(state, time_range, timestamps, rad)
+        if extension is not None:
+            return dash.no_update, extension or dash.no_update, state, badge
 
     # correct for data missing for >2min so that no line in connecting the dots in that case
-    new_timestamps, new_rad = handle_data_gaps(timestamps, rad)
+    new_timestamps, new_rad = handle_data_gaps(timestamps[::-1], rad[::-1])
+    # for the long time ranges plot only the min and max of each interval
+    n_points = len(new_timestamps)
+    new_timestamps, new_rad = downsample(time_range, new_timestamps, new_rad, max_points=max_graph_points)
+    downsampled = len(new_timestamps) < n_points
 
     # Create the figure
     dict = {
-        'data': [{'x': new_timestamps, 'y': rad}],
+        'data': [{'x': new_timestamps, 'y': new_rad}],
         'layout': {
             #'title': f'Global radiation in the Last {time_range} Hours',
             'xaxis': {'tickangle': 45},
@@ -941,7 +878,7 @@ def update_radiation_graph(n_intervals, time_range, refresh_clicks):
     if button_id in ctx.triggered[0]['prop_id']:
         # Reset the zoom by setting 'uirevision' to a unique value
         fig.update_layout(uirevision=str(uuid.uuid4()))
-    return fig, dbc.Badge(f"Last update: {timestamps[0]}", color='secondary' if timestamps[0].replace(tzinfo=timezone.utc) < (utc_now - timedelta(minutes=5)) else 'green')
+    return fig, dash.no_update, graph_state(time_range, new_timestamps, downsampled=downsampled), badge
 
 
 # Modals updates
@@ -0,0 +1,45 @@
+"""
+Micro-benchmark of the assembly of the WS timestamps from the Date/Time values, for a 48 h window
+of readings every 10 s: the loop with datetime.strptime used before, against build_timestamps.
+Run from the dashboard folder: python benchmark_timestamps.py
+"""
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+# modules shared with the WS client, in the root folder of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils_functions import build_timestamps, combine_datetime  # noqa: E402
+
+
+def strptime_loop(date_time_list):
+    """
+    The previous combine_datetime, one strptime per reading.
+    """
+    timestamps = []
+    for date_str, time_str in date_time_list:
+        try:
+            timestamps.append(datetime.strptime(date_str + ' ' + time_str, '%Y%m%d %H%M%S'))
+        except Exception:
+            timestamps.append(None)
+    return timestamps
+
+
+if __name__ == "__main__":
+    start = datetime(2024, 1, 1)
+    readings = [start + timedelta(seconds=10 * i) for i in range(48 * 360)]
+    date_time = [(t.strftime('%Y%m%d'), t.strftime('%H%M%S')) for t in readings]
+    dates = [d for d, _ in date_time]
+    times = [t for _, t in date_time]
+    # same results, apart from the timezone
+    assert list(build_timestamps(dates, times).tz_localize(None).to_pydatetime()) == strptime_loop(date_time)
+
+    repeat = 10
+    results = {
+        'strptime loop': min(timeit.repeat(lambda: strptime_loop(date_time), number=1, repeat=repeat)),
+        'build_timestamps': min(timeit.repeat(lambda: build_timestamps(dates, times), number=1, repeat=repeat)),
+        'combine_datetime': min(timeit.repeat(lambda: combine_datetime(date_time), number=1, repeat=repeat)),
+    }
+    print(f"{len(date_time)} readings (48 h every 10 s), best of {repeat}:")
+    for name, seconds in results.items():
+        print(f"  {name:<18} {seconds * 1000:8.1f} ms  (x{results['strptime loop'] / seconds:.1f})")
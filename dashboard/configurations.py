@@ -40,6 +40,10 @@ time_options = [{'label': '1 Hour', 'value': 1},
                 {'label': '24 Hours', 'value': 24},
                 {'label': '48 Hours', 'value': 48}]
 
+# maximum number of points of each trace of the time-series graphs, above which the readings are downsampled
+# (about two points per pixel of a card)
+max_graph_points = 1500
+
 # sidebar style
 sidebar_style = {
     "text-align": "center",
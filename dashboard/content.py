@@ -115,7 +115,8 @@ def make_plot_card(value_name, dropdown_id, graph_id, timestamp_id):
         size="md",
         color="primary",
         delay_show=1000,
-        children=[dcc.Graph(id=graph_id, figure={}, style={"width": "98%", "height": "100%", "padding": 0}, config=config)]),  # width and height to 100% of the parent element
+        children=[dcc.Graph(id=graph_id, figure={}, style={"width": "98%", "height": "100%", "padding": 0}, config=config),  # width and height to 100% of the parent element
+                  dcc.Store(id=f"{graph_id}-state")]),  # last points sent to the graph, to send only the new ones
         #id=f"{graph_id}-loading",
     )
     return dbc.Card(
@@ -0,0 +1,134 @@
+import threading
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pymongo
+from layout_utils import expand_document, reading_projection
+from utils_functions import build_timestamps
+
+logger = logging.getLogger('app.cache')
+
+
+class ReadingsCache:
+    """
+    Process-wide cache of the recent readings, shared by all the graph callbacks and all the sessions.
+    The readings are fetched from MongoDB at most once every refresh_interval seconds, asking only for
+    the documents added after the last one already cached, and kept as one array per parameter.
+    Every refresh_interval the new readings are appended and the ones older than window hours dropped;
+    every reload_interval the whole window is read again, to get the readings written late (e.g. from the
+    spool file of the WS client).
+    """
+
+    def __init__(self, collection, names, window=48, refresh_interval=30, reload_interval=3600):
+        """
+        Args:
+            collection: Collection of the readings.
+            names: Names of the parameters to cache, e.g. 'Air Temperature'.
+            window: Hours of readings kept.
+            refresh_interval: Minimum seconds between two queries for new readings.
+            reload_interval: Seconds after which the whole window is read again.
+        """
+        self.collection = collection
+        self.names = list(names)
+        self.window = window
+        self.refresh_interval = refresh_interval
+        self.reload_interval = reload_interval
+        self.projection = reading_projection(self.names + ['Date', 'Time'], 'added', 'timestamp')
+        self.lock = threading.Lock()
+        self.refresh_time = 0.  # monotonic time of the last query
+        self.reload_time = 0.  # monotonic time of the last full read
+        self.clear()
+
+    def clear(self):
+        """
+        Empty the cache.
+        """
+        # (added, WS timestamps, {name: values}), all sorted by added, oldest first; the WS datetimes are UTC
+        # without tzinfo. The tuple is replaced with a single assignment at each refresh and never modified,
+        # so that the readers always get arrays of the same refresh
+        self.snapshot = (np.array([], dtype='datetime64[ms]'),
+                         np.array([], dtype=object),
+                         {name: np.array([], dtype=float) for name in self.names})
+
+    def fetch(self, query):
+        """
+        Query the readings and convert them to arrays.
+        Returns:
+            Tuple with the array of added, the array of WS timestamps and the dictionary of the arrays of
+            the values.
+        """
+        docs = [expand_document(doc) for doc in self.collection.find(query, self.projection,
+                                                                      sort=[('added', pymongo.ASCENDING)])]
+        added = np.array([doc['added'].replace(tzinfo=None) for doc in docs], dtype='datetime64[ms]')
+        timestamps = [doc.get('timestamp') for doc in docs]
+        if any(timestamp is None for timestamp in timestamps):
+            # readings stored before the timestamp field existed
+            parsed = build_timestamps([doc.get('Date', {}).get('value') for doc in docs],
+                                      [doc.get('Time', {}).get('value') for doc in docs]).tz_localize(None)
+            parsed = np.where(parsed.isna(), None, parsed.to_pydatetime())
+            timestamps = [t if t is not None else p for t, p in zip(timestamps, parsed)]
+        timestamps = np.array([t.replace(tzinfo=None) if t is not None else None for t in timestamps], dtype=object)
+        columns = {}
+        for name in self.names:
+            values = [doc.get(name, {}).get('value') for doc in docs]
+            columns[name] = np.array([np.nan if value is None else value for value in values], dtype=float)
+        return added, timestamps, columns
+
+    def refresh(self):
+        """
+        Get the new readings from MongoDB, if the last query is older than refresh_interval.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now - self.refresh_time < self.refresh_interval:
+                return
+            self.refresh_time = now
+            cached_added, cached_timestamps, cached_columns = self.snapshot
+            try:
+                if now - self.reload_time >= self.reload_interval or not len(cached_added):
+                    start = datetime.now(timezone.utc) - timedelta(hours=self.window)
+                    added, timestamps, columns = self.fetch({'added': {'$gte': start}})
+                    if not len(added):
+                        # no recent readings, keep the last window of readings
+                        last = self.collection.find_one({}, {'added': 1}, sort=[('added', pymongo.DESCENDING)])
+                        if last is not None:
+                            added, timestamps, columns = self.fetch(
+                                {'added': {'$gte': last['added'] - timedelta(hours=self.window)}})
+                    self.reload_time = now
+                    self.snapshot = (added, timestamps, columns)
+                    logger.info(f'Readings cache reloaded, {len(added)} readings')
+                    return
+                last_added = cached_added[-1].astype(datetime)
+                added, timestamps, columns = self.fetch({'added': {'$gt': last_added}})
+            except Exception as e:
+                logger.error(f'Could not refresh the readings cache: {e}')
+                return
+            # append the new readings and drop the ones out of the window
+            added = np.concatenate([cached_added, added])
+            keep = added >= added[-1] - np.timedelta64(self.window, 'h')
+            self.snapshot = (added[keep],
+                             np.concatenate([cached_timestamps, timestamps])[keep],
+                             {name: np.concatenate([cached_columns[name], columns[name]])[keep] for name in self.names})
+
+    def get(self, names, hours):
+        """
+        Get the readings of the last hours. If there are none, the last hours before the latest reading are
+        given instead.
+        Args:
+            names: Names of the parameters.
+            hours: Hours of readings.
+        Returns:
+            Tuple with the array of WS timestamps and a dictionary with the array of values of each parameter,
+            newest first.
+        """
+        self.refresh()
+        # a single read of the snapshot, a concurrent refresh replaces it as a whole
+        added, timestamps, columns = self.snapshot
+        if not len(added):
+            return timestamps, {name: columns[name] for name in names}
+        end = np.datetime64(datetime.now(timezone.utc).replace(tzinfo=None), 'ms')
+        if added[-1] < end - np.timedelta64(hours, 'h'):
+            end = added[-1]
+        first = np.searchsorted(added, end - np.timedelta64(hours, 'h'), side='left')
+        return timestamps[first:][::-1], {name: columns[name][first:][::-1] for name in names}
@@ -1,11 +1,13 @@
 import dash_bootstrap_components as dbc
 from dash import html
 import numpy as np
+import pandas as pd
 from datetime import datetime
 from bs4 import BeautifulSoup
 import requests
 import xml.etree.ElementTree as ET
 import logging
+from layout_utils import station_datetimes
 
 logger = logging.getLogger('app.functions')
 
@@ -104,6 +106,22 @@ def convert_meteorological_deg2cardinal_dir(deg_measurement):
         return ''
 
 
+def build_timestamps(dates, times):
+    """
+    Combines the dates and times of the WS into timestamps, all at once.
+    Args:
+        dates (list): Dates in the format YYYYMMDD.
+        times (list): Times in the format HHMMSS.
+    Returns:
+        DatetimeIndex: The UTC timestamps (datetime64[ns, UTC]), NaT for the invalid entries.
+    """
+    timestamps = station_datetimes(dates, times)
+    invalid = timestamps.isna().sum()
+    if invalid:
+        logger.error(f'{invalid} invalid timestamp entries out of {len(timestamps)}')
+    return timestamps
+
+
 def combine_datetime(date_time_list):
     """
     Combines a list of dates and times into datetime objects.
@@ -111,19 +129,13 @@ def combine_datetime(date_time_list):
         date_time_list (list): a list of tuples, where each tuple contains a date string in the format YYYYMMDD
         and a time string in the format HHMMSS
     Returns:
-        list: A list of datetime objects.
+        list: A list of datetime objects (UTC without tzinfo), None for the invalid entries.
     """
-    timestamps = []
-    for date_str, time_str in date_time_list:
-        try:
-            dt_str = date_str + ' ' + time_str
-            dt = datetime.strptime(dt_str, '%Y%m%d %H%M%S')
-            timestamps.append(dt)
-        except Exception as e:
-            print(f'Error in entry {date_str}, {time_str}: {e}')
-            logger.error(f'Error in timestamp entry {date_str}, {time_str}: {e}')
-            timestamps.append(None)
-    return timestamps
+    if not len(date_time_list):
+        return []
+    dates, times = zip(*date_time_list)
+    timestamps = build_timestamps(dates, times).tz_localize(None)
+    return list(np.where(timestamps.isna(), None, timestamps.to_pydatetime()))
 
 
 def get_magic_values():
@@ -207,7 +219,9 @@ def get_value_or_nan(dict, key):
 
 def handle_data_gaps(timestamps, *data_lists, max_time_diff=120):
     """
-    Handle data gaps in multiple lists of data with corresponding timestamps.
+    Handle data gaps in multiple lists of data with corresponding timestamps, inserting a separator (None
+    timestamp, NaN values) wherever two consecutive timestamps are at least max_time_diff apart, so that
+    no line is drawn across the gap.
 
     Args:
         timestamps (list): A list of timestamp values.
@@ -215,28 +229,126 @@ def handle_data_gaps(timestamps, *data_lists, max_time_diff=120):
         max_time_diff (float, optional): The maximum time difference allowed to consider data points as continuous. Defaults to 120 seconds.
 
     Returns:
-        Tuple: A tuple containing the updated timestamp list and the updated data lists for the provided data.
+        Tuple: A tuple containing the updated timestamp array and the updated data arrays for the provided data.
+    """
+    timestamps = np.asarray(timestamps, dtype=object)
+    values = np.array([np.asarray(data, dtype=float) for data in data_lists]).reshape(len(data_lists), len(timestamps))
+    # all the differences at once; a missing timestamp is never a gap
+    differences = np.abs(np.diff(pd.DatetimeIndex(timestamps).values))
+    gaps = np.flatnonzero(differences >= np.timedelta64(int(max_time_diff * 1000), 'ms')) + 1
+    # one separator before the first reading after each gap, in all the data lists at once
+    values = np.insert(values, gaps, np.nan, axis=1)
+    return np.insert(timestamps, gaps, None), *values
+
+
+def downsample(time_range, timestamps, *data_lists, max_points=1500):
+    """
+    Reduce the points of the traces of a graph, keeping the min and max of each trace in each time bucket
+    (so that e.g. every gust peak is still shown), the first and last point of each continuous part and the
+    gaps inserted by handle_data_gaps. All the traces keep the same points.
+    Args:
+        time_range (int): Hours shown by the graph, from which the width of the buckets is derived.
+        timestamps (list): Timestamps of the traces, sorted, with None at the gaps, as given by handle_data_gaps.
+        *data_lists (lists): Values of each trace.
+        max_points (int, optional): Maximum number of points of each trace. Defaults to 1500.
+    Returns:
+        Tuple: The timestamps and the values of each trace, as arrays, unchanged if they have less than
+            max_points points.
     """
-    new_data = [[] for _ in range(len(data_lists))]  # initialize empty lists, 3 values -> 3 lists
-    new_timestamps = []  # initialize this with the first timestamp already
-    prev_timestamp = timestamps[0]  # initialize the prev_timestamp with the timestamp of the first entry (which is the MOST RECENT!!)
-    # Initialize each list with the first value
-    new_timestamps.append(timestamps[0])
-    for i in range(len(data_lists)):
-        new_data[i].append(data_lists[i][0])
-    for timestamp, *values in zip(timestamps[1:], *data_lists):
-        time_difference = abs((timestamp - prev_timestamp).total_seconds())
-
-        if time_difference >= max_time_diff:
-            new_timestamps.append(None)
-            for i in range(len(values)):
-                new_data[i].append(None)
-        new_timestamps.append(timestamp)
-        for i, value in enumerate(values):
-            new_data[i].append(value)
-
-        prev_timestamp = timestamp
-    return new_timestamps, *new_data
+    if len(timestamps) <= max_points:
+        return timestamps, *data_lists
+    times = np.asarray(timestamps, dtype=object)
+    gaps = np.equal(times, None)
+    points = np.flatnonzero(~gaps)
+    # each bucket can give a min and a max point for each trace
+    buckets = max(max_points // (2 * len(data_lists)), 1)
+    width = time_range * 3600 * 1000 // buckets
+    ms = pd.DatetimeIndex(times[points]).values.astype('datetime64[ms]').astype(np.int64)
+    # the buckets never span a gap
+    part = np.cumsum(gaps)[points]
+    key = part * (buckets + 1) + np.minimum((ms - ms[0]) // width, buckets)
+    first = np.r_[True, key[1:] != key[:-1]]
+    last = np.r_[key[1:] != key[:-1], True]
+    keep = [points[np.r_[True, part[1:] != part[:-1]]], points[np.r_[part[1:] != part[:-1], True]],
+            np.flatnonzero(gaps)]
+    for values in data_lists:
+        values = np.asarray(values, dtype=float)[points]
+        # key is already sorted, so after sorting by bucket and value the first and last of each bucket are
+        # its min and max; the missing values are never taken as the min or the max
+        order = np.lexsort((np.where(np.isnan(values), np.inf, values), key))
+        keep.append(points[order[first]])
+        order = np.lexsort((np.where(np.isnan(values), -np.inf, values), key))
+        keep.append(points[order[last]])
+    selected = np.unique(np.concatenate(keep))
+    return times[selected], *[np.asarray(values, dtype=object)[selected] for values in data_lists]
+
+
+def graph_state(time_range, new_timestamps, style=None, downsampled=False):
+    """
+    State of a time-series graph after a whole figure has been sent, kept in the Store of the graph.
+    Args:
+        time_range (int): Hours shown by the graph.
+        new_timestamps (list): Timestamps of the traces, oldest first, as given by handle_data_gaps or downsample.
+        style (list, optional): Values changing the look of the traces, e.g. the alert colors.
+        downsampled (bool, optional): Whether the traces were downsampled.
+    Returns:
+        dict: Time range, newest timestamp, style, number of points if downsampled and creation time of the figure.
+    """
+    last = next((t for t in reversed(new_timestamps) if t is not None), None)
+    return {'range': time_range,
+            'last': last.isoformat() if last is not None else None,
+            'style': style,
+            'points': len(new_timestamps) if downsampled else None,
+            'built': datetime.now().timestamp()}
+
+
+def extend_graph(state, time_range, timestamps, *data_lists, style=None, max_time_diff=120, rebuild_interval=3600):
+    """
+    Get the points of a time-series graph newer than the ones already shown, to be sent with the extendData
+    property of the graph instead of a whole figure.
+    Args:
+        state (dict): Data of the Store of the graph, as given by graph_state or by the last call.
+        time_range (int): Hours shown by the graph.
+        timestamps (list): Timestamps of the time range, newest first.
+        *data_lists (lists): Values of each trace, newest first.
+        style (list, optional): Values changing the look of the traces; if they changed, a whole figure is needed.
+        max_time_diff (float, optional): Gap in seconds after which the line is interrupted. Defaults to 120 seconds.
+        rebuild_interval (float, optional): Seconds after which a whole figure is sent anyway, e.g. to show
+            the readings stored late. Defaults to 1 hour.
+    Returns:
+        Tuple: The extendData of the graph (empty if there are no new points, None if a whole figure has to be
+            sent) and the new state.
+    """
+    if (not state or state['last'] is None or state['range'] != time_range or state['style'] != style
+            or datetime.now().timestamp() - state['built'] >= rebuild_interval or not len(timestamps)):
+        return None, state
+    last = datetime.fromisoformat(state['last'])
+    count = 0
+    for timestamp in timestamps:
+        if timestamp is None or timestamp <= last:
+            break
+        count += 1
+    if not count:
+        return (), state
+    # the new points, oldest first, after the last one shown, so that a gap before them is found too
+    new_timestamps, *new_data = handle_data_gaps([last, *timestamps[:count][::-1]],
+                                                 *[[np.nan, *values[:count][::-1]] for values in data_lists],
+                                                 max_time_diff=max_time_diff)
+    new_timestamps, new_data = new_timestamps[1:], [values[1:] for values in new_data]
+    state = dict(state, last=timestamps[0].isoformat())
+    if state['points'] is None:
+        # the traces keep the points of the time range with the gaps between them, the older ones are dropped
+        differences = np.abs(np.diff(pd.DatetimeIndex(timestamps).values))
+        gaps = np.count_nonzero(differences >= np.timedelta64(int(max_time_diff * 1000), 'ms'))
+        max_points = len(timestamps) + int(gaps)
+    else:
+        # the downsampled points do not match the readings, the older ones are dropped at the next whole figure
+        state['points'] += len(new_timestamps)
+        max_points = state['points']
+    extension = ({'x': [new_timestamps] * len(new_data), 'y': new_data},
+                 list(range(len(new_data))),
+                 max_points)
+    return extension, state
 
 
 def handle_rain_alert(precip_alert, rain_alert_timer, time_now):
@@ -0,0 +1,102 @@
+import logging
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from pymongo import IndexModel, ASCENDING, DESCENDING
+
+logger = logging.getLogger('main.indexes')
+
+# Indexes needed by the queries of the WS client, the dashboard and the API, for each collection
+INDEXES = {
+    'readings': [
+        IndexModel([('added', ASCENDING)], name='added'),
+        IndexModel([('timestamp', ASCENDING)], name='timestamp'),
+    ],
+    # the buckets and the rollups are queried on their _id, which is always indexed
+    'buckets': [],
+    'rollups': [],
+}
+
+# Query shapes run on each collection, checked with explain() by utils/check_indexes.py.
+# When a new query is added to the code, add its shape here with the index it needs above.
+QueryShape = namedtuple('QueryShape', ['name', 'collection', 'filter', 'sort'])
+_now = datetime.now(timezone.utc)
+QUERY_SHAPES = [
+    # dashboard: readings of the selected time range, and latest reading if the range is empty
+    QueryShape('dashboard range', 'readings', {'added': {'$gte': _now - timedelta(hours=48)}}, [('added', DESCENDING)]),
+    QueryShape('latest reading', 'readings', {}, [('added', DESCENDING)]),
+    # dashboard: live values
+    QueryShape('latest timestamp', 'readings', {'timestamp': {'$type': 'date'}}, [('timestamp', DESCENDING)]),
+    # API: readings between two datetimes of the station
+    QueryShape('api range', 'readings', {'timestamp': {'$gte': _now - timedelta(days=1), '$lte': _now}},
+               [('timestamp', ASCENDING)]),
+    # info_elog.py: most recent document
+    QueryShape('latest id', 'readings', {}, [('_id', DESCENDING)]),
+    QueryShape('buckets range', 'buckets', {'_id': {'$gte': _now - timedelta(hours=48), '$lte': _now}},
+               [('_id', ASCENDING)]),
+    QueryShape('rollups range', 'rollups', {'_id': {'$gte': _now - timedelta(days=7), '$lte': _now}},
+               [('_id', ASCENDING)]),
+]
+
+
+def ensure_indexes(collection, kind='readings'):
+    """
+    Create the indexes of a collection which do not exist yet.
+    Indexes with the same keys but a different name are considered already there.
+    Args:
+        collection: The collection.
+        kind: Kind of collection, key of INDEXES.
+    Returns:
+        Names of the indexes created.
+    """
+    existing = {tuple(info['key']) for info in collection.index_information().values()}
+    missing = [index for index in INDEXES[kind] if tuple(index.document['key'].items()) not in existing]
+    if not missing:
+        return []
+    created = collection.create_indexes(missing)
+    logger.info(f"### Indexes created on {collection.name}: {', '.join(created)}")
+    return created
+
+
+def ensure_indexes_safe(collection, kind='readings'):
+    """
+    Same as ensure_indexes, but only logging the errors, so that a failure does not stop the caller.
+    """
+    try:
+        return ensure_indexes(collection, kind)
+    except Exception as err:
+        logger.error(f"Could not create the indexes on {collection.name}: {err}")
+        return []
+
+
+def find_stages(plan):
+    """
+    Get the names of all the stages of a query plan.
+    """
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages.extend(find_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(find_stages(value))
+    return stages
+
+
+def check_query_plans(collections):
+    """
+    Run explain() on each query shape and check that none of them scans the whole collection.
+    Args:
+        collections: Dictionary with the collection of each kind, None to skip the kind.
+    Returns:
+        Dictionary with the stages of the winning plan of each query shape checked.
+    """
+    plans = {}
+    for shape in QUERY_SHAPES:
+        collection = collections.get(shape.collection)
+        if collection is None:
+            continue
+        explain = collection.find(shape.filter, sort=shape.sort).explain()
+        plans[shape.name] = find_stages(explain['queryPlanner']['winningPlan'])
+    return plans
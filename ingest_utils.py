@@ -0,0 +1,136 @@
+import os
+import time
+import logging
+from datetime import timezone
+import pandas as pd
+from bson import json_util
+from layout_utils import COMMON_FIELDS, PARAMETER_NAMES, compact_document, expand_document, station_datetimes
+
+logger = logging.getLogger('main.ingest')
+
+# Readings are loaded in bulk from files of these formats:
+# csv, parquet: one row per reading, one column per parameter (name or short key of the compact layout),
+#     e.g. an export of the API or a file of the archive. The datetime of the station is taken from the
+#     Date/Time columns or, if missing, from a 'timestamp' or 'DateTime' column (UTC).
+# jsonl: one document per line, in either layout or as plain {name: value}, e.g. the spool file.
+FORMATS = {'.csv': 'csv', '.parquet': 'parquet', '.jsonl': 'jsonl', '.json': 'jsonl'}
+
+
+def read_file(path, fmt=None):
+    """
+    Read the readings of a file.
+    Args:
+        path: Path of the file.
+        fmt: 'csv', 'parquet' or 'jsonl', from the extension of the file if None.
+    Returns:
+        DataFrame with one row per reading and one column per parameter name.
+    """
+    fmt = fmt or FORMATS.get(os.path.splitext(path)[1].lower())
+    if fmt == 'csv':
+        # Date and Time as strings, to keep the leading zeros
+        df = pd.read_csv(path, dtype={'Date': str, 'Time': str, 'date': str, 'time': str})
+    elif fmt == 'parquet':
+        df = pd.read_parquet(path)
+    elif fmt == 'jsonl':
+        rows = []
+        with open(path, mode='r') as jsonFile:
+            for line in jsonFile:
+                if not line.strip():
+                    continue
+                doc = expand_document(json_util.loads(line))
+                rows.append({key: value.get('value') if isinstance(value, dict) else value
+                             for key, value in doc.items() if key != '_id'})
+        df = pd.DataFrame(rows)
+    else:
+        raise ValueError(f'Unknown format of {path}, use one of {sorted(set(FORMATS.values()))}')
+    return df.rename(columns=PARAMETER_NAMES).drop(columns=['_id'], errors='ignore')
+
+
+def validate(df, parameters):
+    """
+    Check the readings, dropping the invalid ones, and compute their station timestamp.
+    Args:
+        df: DataFrame of the readings, as given by read_file.
+        parameters: Names of the parameters in the Header collection.
+    Returns:
+        DataFrame of the valid readings with their 'timestamp', sorted by time.
+    """
+    timestamp = pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns, UTC]')
+    if 'Date' in df and 'Time' in df:
+        timestamp = pd.Series(station_datetimes(df['Date'], df['Time']), index=df.index)
+    for column in ('timestamp', 'DateTime'):
+        if column in df:
+            timestamp = timestamp.fillna(pd.to_datetime(df[column], errors='coerce', utc=True))
+    df = df.drop(columns=['DateTime'], errors='ignore').assign(timestamp=timestamp)
+
+    invalid = df['timestamp'].isna()
+    if invalid.any():
+        logger.warning(f'### {invalid.sum()} readings without a valid Date/Time, skipped')
+    duplicated = df['timestamp'].duplicated() & ~invalid
+    if duplicated.any():
+        logger.warning(f'### {duplicated.sum()} readings with the same Date/Time of another one, skipped')
+    df = df[~invalid & ~duplicated]
+
+    unknown = [column for column in df.columns if column not in parameters and column not in COMMON_FIELDS]
+    if unknown:
+        logger.warning(f'### Parameters not in the Header collection, skipped: {unknown}')
+    df = df.drop(columns=unknown)
+    # Date and Time of the station as strings, as stored by the WS client
+    df = df.assign(Date=df['timestamp'].dt.strftime('%Y%m%d'), Time=df['timestamp'].dt.strftime('%H%M%S'))
+    return df.sort_values('timestamp', ignore_index=True)
+
+
+def build_documents(df, refs, layout='legacy'):
+    """
+    Create the documents of the readings, as MongoDB.build_document does for a single one.
+    Args:
+        df: DataFrame of the valid readings, as given by validate.
+        refs: ObjectId of each parameter.
+        layout: Layout of the documents, 'legacy' or 'compact'.
+    Returns:
+        List of documents.
+    """
+    names = [column for column in df.columns if column not in COMMON_FIELDS]
+    timestamps = df['timestamp'].dt.to_pydatetime()
+    added = df['added'] if 'added' in df else [None] * len(df)
+    documents = []
+    for row, timestamp, add in zip(df[names].to_dict('records'), timestamps, added):
+        data = {name: {"ref": refs[name], "value": value} for name, value in row.items() if not pd.isna(value)}
+        # without it (e.g. an export of the API, or a blank cell giving NaT) the station timestamp is used, so
+        # that the old readings are not taken by the dashboard as just added
+        data['added'] = pd.Timestamp(add).to_pydatetime() if not pd.isna(add) else timestamp
+        data['timestamp'] = timestamp
+        documents.append(compact_document(data) if layout == 'compact' else data)
+    return documents
+
+
+def load_readings(mongo, df, batch_size=1000, dry_run=False):
+    """
+    Insert the readings in batches, skipping the ones whose station timestamp is already stored, so that
+    the same file can be loaded again.
+    Args:
+        mongo: MongoDB object used for the writes.
+        df: DataFrame of the valid readings, as given by validate.
+        batch_size: Number of readings inserted with each request.
+        dry_run: If True, only count the readings which would be inserted.
+    Returns:
+        Tuple with the number of readings inserted and skipped.
+    """
+    inserted = 0
+    skipped = 0
+    start = time.perf_counter()
+    for i in range(0, len(df), batch_size):
+        batch = df.iloc[i:i + batch_size]
+        timestamps = list(batch['timestamp'].dt.to_pydatetime())
+        stored = {doc['timestamp'].replace(tzinfo=timezone.utc)
+                  for doc in mongo.measurements_col.find({'timestamp': {'$in': timestamps}}, {'timestamp': 1})}
+        new = batch[~batch['timestamp'].isin(list(stored))] if stored else batch
+        skipped += len(batch) - len(new)
+        if len(new) and not dry_run:
+            mongo.insert_many(build_documents(new, mongo.refs, mongo.layout))
+        inserted += len(new)
+        elapsed = time.perf_counter() - start
+        done = i + len(batch)
+        logger.info(f'### {done}/{len(df)} readings ({100 * done / len(df):.0f} %), {inserted} inserted, '
+                    f'{skipped} already stored, {done / elapsed:.0f} readings/s')
+    return inserted, skipped
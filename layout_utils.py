@@ -0,0 +1,135 @@
+"""
+Layouts of the documents of the Readings collection.
+
+legacy: every parameter is stored as {name: {"ref": ObjectId, "value": v}}, e.g.
+    {"Air Temperature": {"ref": ObjectId(...), "value": 7.7}, ..., "added": ..., "timestamp": ...}
+compact: every parameter is stored with a short key and its plain value, the reference to the
+    parameter is kept only in the Header collection, e.g.
+    {"temp": 7.7, ..., "added": ..., "timestamp": ...}
+
+The readers should use reading_projection() to query the fields and expand_document() on the
+results, so that they work with both layouts.
+"""
+import numpy as np
+import pandas as pd
+
+# Short key of each parameter in the compact layout
+COMPACT_KEYS = {
+    "Air Temperature": "temp",
+    "Relative Humidity": "hum",
+    "Absolute Air Pressure": "pres",
+    "Absolute Humidity": "abs_hum",
+    "Average Wind Speed": "avg_wind",
+    "Mean Wind Speed": "mean_wind",
+    "Mean Wind Direction": "wind_dir",
+    "Max Wind": "gust",
+    "Brightness": "bright",
+    "Brightness lux": "bright_lux",
+    "Dew Point Temperature": "dew_point",
+    "Global Radiation": "glob_rad",
+    "Heat Index Temperature": "heat_idx",
+    "Wind Chill Temperature": "wind_chill",
+    "Precipitation Status": "precip_status",
+    "Precipitation Amount": "precip_amt",
+    "Precipitation Intensity": "precip_int",
+    "Precipitation Type": "precip_type",
+    "Mean 10 Wind Speed": "wind_10",
+    "Date": "date",
+    "Time": "time",
+}
+PARAMETER_NAMES = {short: name for name, short in COMPACT_KEYS.items()}
+
+# Fields which are the same in both layouts
+COMMON_FIELDS = ("_id", "added", "timestamp")
+
+
+def compact_value(name, value):
+    """
+    Give the same type to all the values of a parameter: Date and Time are strings (YYYYMMDD, HHMMSS),
+    the numbers are floats, anything else is kept as it is.
+    """
+    if value is None:
+        return None
+    if name == "Date":
+        return str(value).strip()
+    if name == "Time":
+        return str(value).strip().zfill(6)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+
+def compact_document(doc):
+    """
+    Convert a document of the legacy layout to the compact one.
+    Parameters without a short key keep their name.
+    """
+    compact = {}
+    for key, value in doc.items():
+        if key in COMMON_FIELDS:
+            compact[key] = value
+        elif isinstance(value, dict):
+            compact[COMPACT_KEYS.get(key, key)] = compact_value(key, value.get("value"))
+        else:
+            # already compact
+            compact[key] = value
+    return compact
+
+
+def expand_document(doc):
+    """
+    Convert a document of the compact layout to the legacy one, {name: {"value": v}}.
+    Documents already in the legacy layout are returned as they are.
+    """
+    if doc is None:
+        return None
+    expanded = {}
+    for key, value in doc.items():
+        if key in PARAMETER_NAMES:
+            expanded[PARAMETER_NAMES[key]] = {"value": value}
+        elif key in COMMON_FIELDS or isinstance(value, dict):
+            expanded[key] = value
+        else:
+            # compact parameter without a short key
+            expanded[key] = {"value": value}
+    return expanded
+
+
+def reading_projection(names, *fields):
+    """
+    Create the projection to query some parameters from documents of either layout.
+    Args:
+        names: Names of the parameters, e.g. 'Air Temperature'.
+        fields: Other fields to include, e.g. 'added'.
+    Returns:
+        The projection dictionary.
+    """
+    projection = {"_id": 0}
+    for name in names:
+        projection[name + ".value"] = 1
+        if name in COMPACT_KEYS:
+            projection[COMPACT_KEYS[name]] = 1
+    for field in fields:
+        projection[field] = 1
+    return projection
+
+
+def station_datetimes(dates, times):
+    """
+    Create the UTC datetimes of readings from the Date and Time values of the station, all at once.
+    Args:
+        dates: Dates of the station, YYYYMMDD (strings or numbers).
+        times: Times of the station, HHMMSS (leading zeros can be missing).
+    Returns:
+        DatetimeIndex (datetime64[ns, UTC]), NaT where Date/Time are not valid.
+    """
+    # split the numbers into their fields, faster than parsing the strings
+    date = pd.to_numeric(np.asarray(dates, dtype=object), errors='coerce')
+    time = pd.to_numeric(np.asarray(times, dtype=object), errors='coerce')
+    # e.g. '20240101.5' is not a date; the fields of the time are added as offsets, so they are checked here
+    date = np.where(date % 1 == 0, date, np.nan)
+    time = np.where((time % 1 == 0) & (time >= 0) & (time < 240000) & (time // 100 % 100 < 60) & (time % 100 < 60),
+                    time, np.nan)
+    fields = pd.DataFrame({'year': date // 10000, 'month': date // 100 % 100, 'day': date % 100,
+                           'hour': time // 10000, 'minute': time // 100 % 100, 'second': time % 100})
+    return pd.DatetimeIndex(pd.to_datetime(fields, errors='coerce', utc=True)).astype('datetime64[ns, UTC]')
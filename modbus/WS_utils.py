@@ -1,14 +1,17 @@
 import logging
 import sys
+import time
+import struct
+from collections import namedtuple
 from datetime import datetime
 from astropy import units as u
 
-from pymodbus.client import ModbusTcpClient
+from pymodbus.client import ModbusTcpClient, AsyncModbusTcpClient
 from pymodbus.transaction import ModbusRtuFramer
 from pymodbus.constants import Endian
-from pymodbus.payload import BinaryPayloadDecoder, BinaryPayloadBuilder
+from pymodbus.payload import BinaryPayloadBuilder
 from pymodbus.exceptions import ModbusException
-from pymodbus.pdu import ExceptionResponse
+from pymodbus.pdu import ExceptionResponse, ModbusExceptions
 
 logger = logging.getLogger('WS_utils')
 
@@ -64,83 +67,258 @@ def stop_client(client):
     client.close()
 
 
+def decode_32bit(registers, data_type=True):
+    """Decode a 32bit value from a pair of registers, big endian"""
+    return struct.unpack('>i' if data_type else '>I', struct.pack('>HH', *registers))[0]
+
+
 def validator(instance, data_type=True):
     """Decode 32bit register"""
     if not instance.isError():
-        decoder = BinaryPayloadDecoder.fromRegisters(
-            instance.registers,
-            byteorder=Endian.Big,
-            #wordorder=Endian.Big
-        )
-        if not data_type:
-            return decoder.decode_32bit_uint()
-        else:
-            return decoder.decode_32bit_int()
+        return decode_32bit(instance.registers, data_type)
     else:
         # Error handling.
         logger.error('The register does not exist. Try again.')
         return None
 
 
-def readInputRegisters(client, inputregister_dict, precipitationtype_dict):
+def group_registers(addresses, size=2, max_count=125, max_gap=0):
     """
-        Read multiple input registers.
+        Group the registers in blocks of contiguous addresses, each one read with a single request.
+        Args:
+            addresses: Addresses of the values to read.
+            size: Number of registers of each value.
+            max_count: Maximum number of registers read with one request (125 for Modbus).
+            max_gap: Maximum number of unused registers read between two values of the same block.
         Returns:
-            A list of tuples, the tuples contain a sensorID and its value.
+            A list of tuples, the tuples contain the first address, the number of registers and the
+            addresses of the values of a block.
     """
-    logger.info('### Reading input registers')
-    doc = {}  # create a new MongoDB document dict
-    for key, value in inputregister_dict.items():
-        try:
-            rr = client.read_input_registers(address=key-30001, count=2, slave=1)
-            logger.debug('### Input register read correctly')
-        except ModbusException as exc:
-            txt = f'Exception in pymodbus {exc}'
-            logger.error(txt)
-            raise exc
-        if isinstance(rr, ExceptionResponse):
-            txt = f'Received exception from device {rr}!'
-            logger.error(txt)
-            # THIS IS NOT A PYTHON EXCEPTION, but a valid modbus message
-            raise ModbusException(txt)
-        if rr.isError():
-            txt = f'Pymodbus returned an error: {rr}'
-            logger.error(txt)
-            raise ModbusException(txt)
-        if rr == 0x7FFFFFFF or rr == 0xFFFFFFFF:
-            logger.error(f'### Error detected, incorrect measured value: {rr}')
-
-        data = validator(rr, data_type=value[3])
-        if (key == 31407):  # precipitation type
-            precipitation_type = int(data)
-            for key_p, value_p in precipitationtype_dict.items():
-                if (precipitation_type == int(key_p)):
-                    print(f'Register {key}, {value[0]}: {value_p} \n')
-                    doc.update({str(value[0]): value_p})
-        elif (key == 31401):
-            data = int(data)
-            print(f'Register {key}, {value[0]}: {data} \n')
-            doc.update({str(value[0]): data})
-        elif (key == 34601):
-            data = int(data)
-            #data = datetime.strptime(str(data), '%Y%m%d').date()
-            print(f'Register {key}, {value[0]}: {data} \n')
-            doc.update({str(value[0]): data})
-        elif (key == 34603):
-            data = int(data)
-            #data = datetime.strptime(str(data), '%H%M%S').time()
-            print(f'Register {key}, {value[0]}: {data} \n')
-            doc.update({str(value[0]): data})
-        #elif (key == 30003 or key == 30019):  # convert wind measurement from m/s to km/h
-        #    data_formatter = '.2f'
-        #    data = data * 3.6
-        #    print(f'Register {key}, {value[0]}: {data/value[1]:>{data_formatter}} km/h \n')
+    blocks = []
+    for address in sorted(addresses):
+        if blocks:
+            start, count, values = blocks[-1]
+            gap = address - (start + count)
+            if 0 <= gap <= max_gap and address + size - start <= max_count:
+                blocks[-1] = (start, address + size - start, values + [address])
+                continue
+        blocks.append((address, size, [address]))
+    return blocks
+
+
+def readRegisterBlock(client, address, count):
+    """
+        Read contiguous input registers with a single request.
+        Returns:
+            The list of registers.
+    """
+    try:
+        rr = client.read_input_registers(address=address-30001, count=count, slave=1)
+        logger.debug('### Input registers read correctly')
+    except ModbusException as exc:
+        txt = f'Exception in pymodbus {exc}'
+        logger.error(txt)
+        raise exc
+    return checkResponse(rr)
+
+
+async def readRegisterBlockAsync(client, address, count):
+    """
+        Same as readRegisterBlock, with the asyncio client.
+    """
+    try:
+        rr = await client.read_input_registers(address=address-30001, count=count, slave=1)
+        logger.debug('### Input registers read correctly')
+    except ModbusException as exc:
+        txt = f'Exception in pymodbus {exc}'
+        logger.error(txt)
+        raise exc
+    return checkResponse(rr)
+
+
+class BlockRefused(ModbusException):
+    """
+        The device answered that a block of registers contains an address it does not map.
+    """
+
+
+def checkResponse(rr):
+    """
+        Check the response of a read request.
+        Returns:
+            The list of registers.
+    """
+    if isinstance(rr, ExceptionResponse):
+        txt = f'Received exception from device {rr}!'
+        logger.error(txt)
+        # THIS IS NOT A PYTHON EXCEPTION, but a valid modbus message
+        if rr.exception_code == ModbusExceptions.IllegalAddress:
+            raise BlockRefused(txt)
+        raise ModbusException(txt)
+    if rr.isError():
+        txt = f'Pymodbus returned an error: {rr}'
+        logger.error(txt)
+        raise ModbusException(txt)
+    return rr.registers
+
+
+def registerBlockReader(blocks, size=2):
+    """
+        Plan the reading of the blocks of input registers, for both the sync and the asyncio client.
+        The generator yields the (address, count) of each read request and receives the registers read,
+        or None if the device refused the block (BlockRefused). A refused block is split in the list,
+        first in its contiguous parts and then in single values, and read again; any other error is left
+        to the caller, so that e.g. a timeout does not split the blocks.
+        Returns:
+            A dictionary with the registers of each address, as value of the StopIteration.
+    """
+    registers = {}
+    new_blocks = []
+    pending = list(blocks)
+    while pending:
+        start, count, addresses = pending.pop(0)
+        block = yield start, count
+        if block is None:
+            if len(addresses) == 1:
+                raise BlockRefused(f'Register {start} refused by the device')
+            pending[:0] = splitBlock(start, count, addresses, size)
+            continue
+        new_blocks.append((start, count, addresses))
+        for address in addresses:
+            registers[address] = block[address - start:address - start + size]
+    blocks[:] = new_blocks
+    return registers
+
+
+def readRegisterBlocks(client, blocks, size=2):
+    """
+        Read the blocks of input registers (see registerBlockReader).
+        Returns:
+            A dictionary with the registers of each address.
+    """
+    reader = registerBlockReader(blocks, size)
+    try:
+        request = next(reader)
+        while True:
+            try:
+                block = readRegisterBlock(client, *request)
+            except BlockRefused:
+                block = None
+            request = reader.send(block)
+    except StopIteration as stop:
+        return stop.value
+
+
+async def readRegisterBlocksAsync(client, blocks, size=2):
+    """
+        Same as readRegisterBlocks, with the asyncio client.
+    """
+    reader = registerBlockReader(blocks, size)
+    try:
+        request = next(reader)
+        while True:
+            try:
+                block = await readRegisterBlockAsync(client, *request)
+            except BlockRefused:
+                block = None
+            request = reader.send(block)
+    except StopIteration as stop:
+        return stop.value
+
+
+def splitBlock(start, count, addresses, size=2):
+    """
+        Split a block refused by the device, first in its contiguous parts and then in single values.
+    """
+    parts = group_registers(addresses, size=size, max_count=count)
+    if len(parts) == 1:
+        parts = [(address, size, [address]) for address in addresses]
+    logger.warning(f'### Block of {count} registers from {start} refused, split in {len(parts)} blocks')
+    return parts
+
+
+# Values returned by the WS when a measurement is not valid, for signed and unsigned registers
+INVALID_VALUES = {True: (0x7FFFFFFF,), False: (0x7FFFFFFF, 0xFFFFFFFF)}
+# Registers stored as integers, without scaling
+INTEGER_REGISTERS = (31401, 34601, 34603)  # precipitation status, date, time
+
+DecodeEntry = namedtuple('DecodeEntry', ['name', 'scale', 'integer', 'invalid', 'enum'])
+DecodeTable = namedtuple('DecodeTable', ['addresses', 'registers', 'values', 'entries'])
+
+
+def build_decode_table(inputregister_dict, enums=None, integers=INTEGER_REGISTERS):
+    """
+        Create the table used to decode all the input registers at once.
+        Args:
+            inputregister_dict: Map of the input registers.
+            enums: Dictionary with the values of the registers that are codes, e.g. {31407: precipitationtype_dict}.
+            integers: Registers stored as integers.
+        Returns:
+            The DecodeTable.
+    """
+    enums = enums or {}
+    addresses = list(inputregister_dict)
+    entries = []
+    for address in addresses:
+        name, scale, unit, signed = inputregister_dict[address][:4]
+        enum = {int(code): text for code, text in enums[address].items()} if address in enums else None
+        entries.append(DecodeEntry(str(name), scale, address in integers, INVALID_VALUES[bool(signed)], enum))
+    return DecodeTable(
+        addresses=addresses,
+        # all the registers, as big endian 16bit words
+        registers=struct.Struct(f'>{2 * len(addresses)}H'),
+        # the same bytes as big endian 32bit values, signed (i) or unsigned (I)
+        values=struct.Struct('>' + ''.join('i' if inputregister_dict[address][3] else 'I' for address in addresses)),
+        entries=entries,
+    )
+
+
+def decode_registers(registers, table):
+    """
+        Decode the values of all the input registers at once.
+        Args:
+            registers: Dictionary with the pair of registers of each address.
+            table: DecodeTable of the registers.
+        Returns:
+            The record dict, with the name and value of each register. Invalid values are None, codes
+            missing from their enum are left out.
+    """
+    words = [word for address in table.addresses for word in registers[address]]
+    values = table.values.unpack(table.registers.pack(*words))
+    doc = {}
+    for entry, data in zip(table.entries, values):
+        if data & 0xFFFFFFFF in entry.invalid:
+            logger.error(f'### Error detected, incorrect measured value of {entry.name}: {data & 0xFFFFFFFF:#x}')
+            doc[entry.name] = None
+        elif entry.enum is not None:
+            if data in entry.enum:
+                doc[entry.name] = entry.enum[data]
         else:
-            print(f'Register {key}, {value[0]}: {data/value[1]} {value[2]} \n')
-            doc.update({str(value[0]): data/value[1]})
+            doc[entry.name] = data if entry.integer else data / entry.scale
     return doc
 
 
+def readInputRegisters(client, inputregister_dict, precipitationtype_dict, blocks=None, table=None):
+    """
+        Read multiple input registers.
+        The registers are read in blocks of contiguous addresses, see group_registers, and decoded at
+        once, see decode_registers.
+        Args:
+            blocks: Blocks of the registers, created once with group_registers(inputregister_dict).
+                If None, they are created at each call.
+            table: DecodeTable of the registers, created once with build_decode_table. If None, it is
+                created at each call.
+        Returns:
+            The record dict, with the name and value of each register.
+    """
+    logger.info('### Reading input registers')
+    if blocks is None:
+        blocks = group_registers(inputregister_dict)
+    if table is None:
+        table = build_decode_table(inputregister_dict, enums={31407: precipitationtype_dict})
+    return decode_registers(readRegisterBlocks(client, blocks), table)
+
+
 def readHoldingRegisters(client, holdingregister_dict):
     """Read multiple holding registers"""
     logger.info('### Reading holding registers')
@@ -256,3 +434,111 @@ holdingregister_dict = {40015: ['Averaging interval for wind speed and wind dire
                         40021: ['Time zone',                                          ],
                         45001: ['Thies aricle number',                                ],
                         }
+
+
+class ModbusConnection():
+    """
+    Asyncio client for the Modbus interface of the WS, with the same interface as OPCUAConnection so
+    that it can be used as acquisition source of the ingestion pipeline.
+    The connection is kept open across the reading cycles. If it dies, it is reopened at the next
+    cycle, waiting with an exponential backoff between failed attempts.
+    """
+
+    # Names of the registers in the Header collection, if different
+    header_names = {'Gusts Velocity': 'Max Wind',
+                    'Brightness (kLux)': 'Brightness',
+                    'Brightness (Lux)': 'Brightness lux'}
+    # Registers not stored in the Header collection
+    excluded = ('Internal Temperature', 'Height')
+
+    def __init__(self, host='10.1.101.77', port=502, min_backoff=1, max_backoff=60, max_gap=8, timeout=2.):
+        """
+        Args:
+            host: IP address of the ExpertDAQ converter.
+            port: Port of the ExpertDAQ serial port.
+            min_backoff: Seconds to wait after the first failed connection attempt.
+            max_backoff: Maximum seconds to wait between two connection attempts.
+            max_gap: Maximum number of unused registers read to merge two blocks, see group_registers.
+            timeout: Seconds to wait for each request.
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.client = None
+        self.blocks = group_registers(inputregister_dict, max_gap=max_gap)
+        self.table = build_decode_table(inputregister_dict, enums={31407: precipitationtype_dict})
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = min_backoff
+        self.next_attempt = 0.  # monotonic time before which no reconnection is tried
+        self.connect_time = 0.  # seconds spent connecting in the last cycle
+        self.read_time = 0.  # seconds spent reading in the last cycle
+
+    @property
+    def is_connected(self):
+        return self.client is not None
+
+    async def connect(self):
+        """
+        Open the connection with the converter, if not already open.
+        Returns:
+            True if the connection is open, False if it failed or the backoff is not over yet.
+        """
+        if self.client is not None:
+            return True
+        if time.monotonic() < self.next_attempt:
+            return False
+        client = AsyncModbusTcpClient(host=self.host, port=self.port, framer=ModbusRtuFramer, timeout=self.timeout)
+        try:
+            await client.connect()
+            if not client.connected:
+                raise ConnectionError('connection refused')
+        except Exception as e:
+            client.close()
+            logger.error(f"Can not connect to Modbus. Error: {e}. Next attempt in {self.backoff}s.")
+            self.next_attempt = time.monotonic() + self.backoff
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            return False
+        self.client = client
+        self.backoff = self.min_backoff
+        logger.info(f'Connected to Modbus {self.host}:{self.port}')
+        return True
+
+    async def disconnect(self):
+        """
+        Close the connection with the converter.
+        """
+        if self.client is None:
+            return
+        client, self.client = self.client, None
+        client.close()
+        logger.info(f'Disconnected from Modbus {self.host}:{self.port}')
+
+    async def read(self):
+        """
+        Read all the input registers, (re)connecting if needed.
+        The time spent in connecting and in reading is stored in connect_time and read_time.
+        Returns:
+            Dictionary with the pair parameter/value of each register, empty if nothing could be read.
+        """
+        start = time.perf_counter()
+        connected = await self.connect()
+        self.connect_time = time.perf_counter() - start
+        self.read_time = 0.
+        if not connected:
+            return {}
+        start = time.perf_counter()
+        try:
+            doc = decode_registers(await readRegisterBlocksAsync(self.client, self.blocks), self.table)
+        except Exception as e:
+            logger.error(f"Lost connection to Modbus. Error: {e}")
+            await self.disconnect()
+            return {}
+        finally:
+            self.read_time = time.perf_counter() - start
+        data = {self.header_names.get(name, name): value for name, value in doc.items() if name not in self.excluded}
+        # same format as the OPC UA values, YYYYMMDD and HHMMSS
+        if data.get('Date') is not None and data.get('Time') is not None:
+            data['Date'] = str(data['Date'])
+            data['Time'] = str(data['Time']).zfill(6)
+        return data
@@ -3,6 +3,8 @@ from modbus.WS_utils import (
     connect_client,
     #readHoldingRegister,
     readInputRegisters,
+    group_registers,
+    build_decode_table,
     #stop_client,
     inputregister_dict,
     precipitationtype_dict,
@@ -11,6 +13,11 @@ from mongo_utils import MongoDB
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import time
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+max_gap = int(os.environ.get('MODBUS_MAX_GAP', 8))  # unused registers read to merge two blocks
 
 #---------------------------------------------------------------------------#
 # Initialize the main logger
@@ -31,9 +38,15 @@ def main():
     # Connect to MongoDB, to a particular db and collection
     mongo = MongoDB()
 
+    # Group the registers in blocks read with a single request each
+    blocks = group_registers(inputregister_dict, max_gap=max_gap)
+    logger.info(f'### {len(inputregister_dict)} input registers read with {len(blocks)} requests')
+    # Table to decode all the registers at once
+    table = build_decode_table(inputregister_dict, enums={31407: precipitationtype_dict})
+
     # Read and store loop
     while isClientConnected:
-        data = readInputRegisters(WS_client, inputregister_dict, precipitationtype_dict)
+        data = readInputRegisters(WS_client, inputregister_dict, precipitationtype_dict, blocks, table)
         # use the insert method to insert a document into the collection
         mongo.insert(data)
         # sleep 1s before next polling
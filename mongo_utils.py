@@ -1,10 +1,17 @@
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+from pymongo import UpdateOne, ReplaceOne
 import logging
 import pymongo
 from datetime import datetime, timezone
+import time
 from bson.objectid import ObjectId
+from bson import json_util
 from dotenv import load_dotenv
 import os
+from layout_utils import compact_document, expand_document, reading_projection, station_datetimes
+from bucket_utils import append_to_buckets
+from rollup_utils import INTERVALS, update_rollups, rebuild_rollups
 
 logger = logging.getLogger('main.mongo')
 #logger.setLevel(logging.DEBUG)
@@ -13,9 +20,45 @@ logger = logging.getLogger('main.mongo')
 load_dotenv()
 
 
+def station_timestamps(dates, times):
+    """
+    Create the UTC datetimes of readings from the Date and Time values of the station.
+    Args:
+        dates: Dates of the station, YYYYMMDD.
+        times: Times of the station, HHMMSS (leading zeros can be missing).
+    Returns:
+        List of datetimes, None where Date/Time are not valid.
+    """
+    timestamps = station_datetimes(dates, times)
+    return [None if invalid else timestamp for timestamp, invalid in zip(timestamps.to_pydatetime(), timestamps.isna())]
+
+
+def station_timestamp(date, time_str):
+    """
+    Create the UTC datetime of a reading from the Date and Time values of the station.
+    Args:
+        date: Date of the station, YYYYMMDD.
+        time_str: Time of the station, HHMMSS (leading zeros can be missing).
+    Returns:
+        The datetime, or None if Date/Time are not valid.
+    """
+    # a single reading is parsed directly, station_timestamps is much slower for one value;
+    # the values are checked as numbers like station_datetimes does, e.g. '20240101.0' is a valid Date
+    try:
+        date, time_str = float(date), float(time_str)
+        if date % 1 or time_str % 1 or time_str < 0:
+            return None
+        return datetime.strptime(f"{int(date):08d} {int(time_str):06d}", '%Y%m%d %H%M%S').replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
 class MongoDB:
     """
     Class to take care of storing the data from the WS to mongo database.
+    The MongoClient keeps a pool of connections, so the same object should be reused for all the
+    insertions. The parameters of the Header collection are cached and refreshed when an unknown
+    parameter is found or every refresh_interval seconds.
     """
 
     parameters = {}
@@ -27,8 +70,12 @@ class MongoDB:
     db_port = os.environ.get('DB_PORT')
     db_name = os.environ.get('DB_NAME')
     uri = 'mongodb://' + db_host + ':' + db_port
+    layout = os.environ.get('DB_LAYOUT', 'legacy')
+    buckets = os.environ.get('DB_BUCKETS') or None
+    rollups = os.environ.get('DB_ROLLUPS') or None
 
-    def __init__(self, uri=uri, dbName=db_name, parameters='Header', measurements='Readings'):
+    def __init__(self, uri=uri, dbName=db_name, parameters='Header', measurements='Readings', refresh_interval=3600,
+                 layout=layout, buckets=buckets, rollups=rollups):
         """
         Constructor; initializes defaults.
         Args:
@@ -36,7 +83,19 @@ class MongoDB:
             uri: Database connection uri.
             parameters: Name of header collection, containing info of each register of the WS
             measurements: Name of the measureament collection, contains the values read from the WS
+            refresh_interval: Seconds after which the cached parameters are read again from the header collection
+            layout: Layout of the inserted documents, 'legacy' or 'compact' (see layout_utils)
+            buckets: Name of the collection of the hourly buckets (see bucket_utils), None to not store them
+            rollups: Prefix of the collections of the rollups (see rollup_utils), e.g. 'Rollups' for
+                Rollups_1min, Rollups_10min and Rollups_1h; None to not store them
         """
+        self.layout = layout
+        self.parameters = {}
+        self.refs = {}  # ObjectId of each parameter
+        self.parameters_time = 0.  # monotonic time of the last refresh of the parameters
+        self.refresh_interval = refresh_interval
+        self.insert_time = 0.  # seconds taken by the last insert
+        self.dbName = dbName
         try:
             self.client = MongoClient(uri)
             logger.info('### Connected to MongoDB')
@@ -46,6 +105,8 @@ class MongoDB:
         self.database = self.client[dbName]
         self.parameters_col = self.database[parameters]
         self.measurements_col = self.database[measurements]
+        self.buckets_col = self.database[buckets] if buckets else None
+        self.rollup_cols = {interval: self.database[f'{rollups}_{interval}'] for interval in INTERVALS} if rollups else {}
         self.get_parameters()
 
     def get_parameters(self):
@@ -53,12 +114,44 @@ class MongoDB:
         Get name of parameter from parameters collection
         """
         entries = self.parameters_col.find().sort([("name", pymongo.ASCENDING)])
+        parameters = {}
         for entry in entries:
             #entry: {'_id': ObjectId('642494aba6ed43dd2570736c'), 'parameter': 'wind', 'description': 'Wind speed', 'units': 'm/s', 'added': datetime.datetime(2023, 3, 29, 19, 42, 35, 899000)}
-            self.parameters[entry['name']] = entry
+            parameters[entry['name']] = entry
         #print("parameters: ", self.parameters)
+        self.parameters = parameters
+        self.refs = {name: ObjectId(entry['_id']) for name, entry in parameters.items()}
+        self.parameters_time = time.monotonic()
         return self.parameters
 
+    def refresh_parameters(self):
+        """
+        Read again the parameters from the header collection, keeping the cached ones if the database can not be reached.
+        """
+        try:
+            self.get_parameters()
+        except Exception as err:
+            logger.error(f'Could not refresh the parameters from MongoDB: {err}')
+        return self.parameters
+
+    def get_latest(self, keys=("Date", "Time")):
+        """
+        Get the values of the given parameters in the latest document of the measurements collection.
+        Args:
+            keys: Names of the parameters.
+        Returns:
+            Tuple with the values, None if the collection is empty or can not be read.
+        """
+        try:
+            latest = expand_document(self.measurements_col.find_one({}, reading_projection(keys),
+                                                                    sort=[('added', pymongo.DESCENDING)]))
+        except Exception as err:
+            logger.error(f'Could not read the latest entry from MongoDB: {err}')
+            return None
+        if latest is None:
+            return None
+        return tuple(latest.get(key, {}).get('value') for key in keys)
+
     def MongoDB_Connection(self, dbCollection):
         """
         Connect to the mongoDB sever local network
@@ -97,21 +190,28 @@ class MongoDB:
         """
         return self.client[self.dbName][dbCollection]
 
-    def insert(self, dic, added=None):
+    def build_document(self, dic, added=None):
         """
-        It inserts a new document to a collection.
+        It creates the document of a measurement, linking each value to its parameter.
         Args:
             dic: Dictionary containing the pair parameter/measurement of each register.
+            added: Time of the insertion, now if not given.
+        Returns:
+            The document, or None if one of the parameters is unknown.
         """
+        if time.monotonic() - self.parameters_time > self.refresh_interval:
+            self.refresh_parameters()
         data = {}
         for key, value in dic.items():
+            if key not in self.parameters:
+                # the parameter could have been added after the last refresh
+                self.refresh_parameters()
             if key not in self.parameters:
                 logger.error(f'### Parameter {key} cannot be found!')
                 return None
-            _id = ObjectId(self.parameters[key]['_id'])
             data.update({
                 key: {
-                    "ref": _id,
+                    "ref": self.refs[key],
                     "value": value,
                 }
             })
@@ -120,12 +220,185 @@ class MongoDB:
         data.update({
             "added": added,
         })
+        # datetime of the station, so that the readers don't need to parse Date/Time
+        timestamp = station_timestamp(dic.get('Date'), dic.get('Time'))
+        if timestamp is not None:
+            data['timestamp'] = timestamp
+        else:
+            logger.warning(f"### Invalid Date/Time of the station: {dic.get('Date')}, {dic.get('Time')}")
+        if self.layout == 'compact':
+            data = compact_document(data)
+        return data
+
+    def insert(self, dic, added=None):
+        """
+        It inserts a new document to a collection.
+        Args:
+            dic: Dictionary containing the pair parameter/measurement of each register.
+        """
+        data = self.build_document(dic, added)
+        if data is None:
+            return None
         # push to DB
+        start = time.perf_counter()
         try:
             self.measurements_col.insert_one(data)
-            logger.info("### Values added to MongoDB")
+            self.update_summaries([data])
+            logger.info(f"### Values added to MongoDB in {time.perf_counter() - start:.3f} s")
         except Exception:
             logger.error(f'### Failed to add entry to the DB: {data}')
+        finally:
+            self.insert_time = time.perf_counter() - start
+
+    def insert_many(self, documents):
+        """
+        It inserts a batch of documents with a single request.
+        Documents already in the collection (same _id) are skipped, any other error is raised.
+        The documents are also added to the hourly buckets and to the rollups, if enabled.
+        Args:
+            documents: List of documents created with build_document.
+        """
+        start = time.perf_counter()
+        try:
+            try:
+                self.measurements_col.insert_many(documents, ordered=False)
+            except BulkWriteError as err:
+                # 11000: duplicate key, the document was already inserted
+                if any(error['code'] != 11000 for error in err.details['writeErrors']):
+                    raise
+            self.update_summaries(documents)
+        finally:
+            self.insert_time = time.perf_counter() - start
+        logger.info(f"### {len(documents)} values added to MongoDB in {self.insert_time:.3f} s")
+
+    def update_summaries(self, documents):
+        """
+        Add the documents to the hourly buckets and to the rollups, if enabled.
+        Readings already added are skipped, so that the documents can be written again.
+        """
+        if self.buckets_col is not None:
+            append_to_buckets(self.buckets_col, documents, self.parameters)
+        if self.rollup_cols:
+            update_rollups(self.rollup_cols, documents)
+
+    def backfill_timestamps(self, batch_size=1000):
+        """
+        Add the datetime of the station to the documents inserted without it.
+        Args:
+            batch_size: Number of documents updated with each request.
+        Returns:
+            Number of documents updated.
+        """
+        updated = 0
+        invalid = 0
+        docs = []
+
+        def write():
+            # the invalid ones are marked with None, so that they are not checked again
+            timestamps = station_timestamps([doc.get('Date', {}).get('value') for doc in docs],
+                                            [doc.get('Time', {}).get('value') for doc in docs])
+            requests = [UpdateOne({'_id': doc['_id']}, {'$set': {'timestamp': timestamp}})
+                        for doc, timestamp in zip(docs, timestamps)]
+            docs.clear()
+            return self.measurements_col.bulk_write(requests, ordered=False).modified_count, timestamps.count(None)
+
+        # Date/Time of either layout, with the _id to update the document
+        projection = dict(reading_projection(['Date', 'Time']), _id=1)
+        cursor = self.measurements_col.find({'timestamp': {'$exists': False}}, projection, batch_size=batch_size)
+        for doc in cursor:
+            docs.append(expand_document(doc))
+            if len(docs) >= batch_size:
+                modified, missing = write()
+                updated += modified
+                invalid += missing
+                logger.info(f'### {updated} documents updated')
+        if docs:
+            modified, missing = write()
+            updated += modified
+            invalid += missing
+        logger.info(f'### Timestamp added to {updated} documents, {invalid} with invalid Date/Time')
+        return updated
+
+    def migrate_to_compact(self, batch_size=1000):
+        """
+        Convert the documents of the measurements collection from the legacy layout to the compact one.
+        The datetime of the station is added to the documents inserted without it. The documents are read with a cursor and replaced in batches, so that the migration can run
+        on the whole collection and can be stopped and restarted.
+        Args:
+            batch_size: Number of documents replaced with each request.
+        Returns:
+            Number of documents converted.
+        """
+        converted = 0
+        docs = []
+
+        def write():
+            missing = [doc for doc in docs if 'timestamp' not in doc]
+            if missing:
+                # the Date/Time sub-documents are gone after the conversion, so backfill_timestamps could not do it
+                timestamps = station_timestamps([doc['Date'].get('value') for doc in missing],
+                                                [doc.get('Time', {}).get('value') for doc in missing])
+                for doc, timestamp in zip(missing, timestamps):
+                    doc['timestamp'] = timestamp
+            requests = [ReplaceOne({'_id': doc['_id']}, compact_document(doc)) for doc in docs]
+            docs.clear()
+            return self.measurements_col.bulk_write(requests, ordered=False).modified_count
+
+        # the legacy documents have the station Date as a sub-document
+        cursor = self.measurements_col.find({'Date.value': {'$exists': True}}, batch_size=batch_size)
+        for doc in cursor:
+            docs.append(doc)
+            if len(docs) >= batch_size:
+                converted += write()
+                logger.info(f'### {converted} documents converted')
+        if docs:
+            converted += write()
+        logger.info(f'### {converted} documents converted to the compact layout')
+        return converted
+
+    def fill_buckets(self, batch_size=1000):
+        """
+        Append the readings of the measurements collection to the hourly buckets, e.g. when the buckets are
+        enabled on an existing database. Readings already in their bucket are skipped, so it can be run again.
+        Args:
+            batch_size: Number of readings appended with each request.
+        Returns:
+            Number of readings read.
+        """
+        if self.buckets_col is None:
+            raise ValueError('The collection of the buckets is not set (DB_BUCKETS)')
+        count = 0
+        documents = []
+        cursor = self.measurements_col.find({'timestamp': {'$type': 'date'}}, batch_size=batch_size).sort('timestamp', pymongo.ASCENDING)
+        for doc in cursor:
+            documents.append(doc)
+            if len(documents) >= batch_size:
+                append_to_buckets(self.buckets_col, documents, self.parameters)
+                count += len(documents)
+                documents = []
+                logger.info(f'### {count} readings added to the buckets')
+        if documents:
+            append_to_buckets(self.buckets_col, documents, self.parameters)
+            count += len(documents)
+        logger.info(f'### {count} readings added to the buckets')
+        return count
+
+    def rebuild_rollups(self, start=None, batch_size=1000):
+        """
+        Compute again the rollups from the measurements collection (see rollup_utils.rebuild_rollups).
+        """
+        if not self.rollup_cols:
+            raise ValueError('The collections of the rollups are not set (DB_ROLLUPS)')
+        return rebuild_rollups(self.measurements_col, self.rollup_cols, start=start, batch_size=batch_size)
+
+    def collection_stats(self):
+        """
+        Get the size of the measurements collection.
+        Returns:
+            Dictionary with number of documents, average document size, data size and storage size in bytes.
+        """
+        stats = self.database.command('collStats', self.measurements_col.name)
+        return {key: stats.get(key) for key in ('count', 'avgObjSize', 'size', 'storageSize')}
 
     def close_connection(self):
         """
@@ -137,3 +410,84 @@ class MongoDB:
         except Exception as err:
             #print("Could not discconnect from MongoDB: %s" % err)
             logger.error(f'Could not disconnect from MongoDB: {err}')
+
+
+class WriteBehindBuffer:
+    """
+    Class to collect the documents of the measurements and write them to MongoDB in batches.
+    If the database is not reachable, the documents are appended to a local spool file, which
+    is written back to the database as soon as it is available again.
+    """
+
+    def __init__(self, mongo, batch_size=10, max_delay=30, spool_path='WS_spool.jsonl', replay_batch=1000):
+        """
+        Args:
+            mongo: MongoDB object used for the writes.
+            batch_size: Number of documents that triggers a write.
+            max_delay: Seconds after which the documents are written even if the batch is not full.
+            spool_path: Path of the file where the documents are kept while MongoDB is down.
+            replay_batch: Number of documents of the spool file written with each request.
+        """
+        self.mongo = mongo
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.spool_path = spool_path
+        self.replay_batch = replay_batch
+        self.documents = []
+        self.first_time = None  # monotonic time of the oldest document in the buffer
+
+    def add(self, dic, added=None):
+        """
+        Add a measurement to the buffer, writing the buffer if the batch is full or too old.
+        Args:
+            dic: Dictionary containing the pair parameter/measurement of each register.
+            added: Time of the insertion, now if not given.
+        """
+        data = self.mongo.build_document(dic, added)
+        if data is None:
+            return
+        # set the id here so that a document written twice (e.g. from the spool) is not duplicated
+        data['_id'] = ObjectId()
+        if not self.documents:
+            self.first_time = time.monotonic()
+        self.documents.append(data)
+        if len(self.documents) >= self.batch_size or time.monotonic() - self.first_time >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the documents of the buffer to MongoDB, first replaying the spool file if any.
+        If the write fails, the documents are appended to the spool file.
+        """
+        documents, self.documents = self.documents, []
+        try:
+            self.replay()
+            if documents:
+                self.mongo.insert_many(documents)
+        except Exception as err:
+            logger.error(f'### MongoDB not available, {len(documents)} values added to the spool file: {err}')
+            self.spool(documents)
+
+    def spool(self, documents):
+        """
+        Append the documents to the spool file, one JSON document per line.
+        """
+        if not documents:
+            return
+        with open(self.spool_path, mode='a') as spoolFile:
+            for data in documents:
+                spoolFile.write(json_util.dumps(data) + '\n')
+
+    def replay(self):
+        """
+        Write the documents of the spool file to MongoDB in bulk and remove the file.
+        An exception is raised if MongoDB is not available, keeping the file.
+        """
+        if not os.path.exists(self.spool_path):
+            return
+        with open(self.spool_path, mode='r') as spoolFile:
+            documents = [json_util.loads(line) for line in spoolFile if line.strip()]
+        for i in range(0, len(documents), self.replay_batch):
+            self.mongo.insert_many(documents[i:i + self.replay_batch])
+        os.remove(self.spool_path)
+        logger.info(f'### {len(documents)} values of the spool file added to MongoDB')
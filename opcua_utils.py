@@ -1,6 +1,10 @@
 import logging
 import json
-from asyncua import Client
+import time
+import asyncio
+from collections import namedtuple
+from functools import lru_cache
+from asyncua import Client, ua
 from dotenv import load_dotenv
 import os
 
@@ -11,81 +15,411 @@ logger = logging.getLogger('main.asyncua')
 load_dotenv()
 dps_path = os.environ.get('DPS_PATH', './')
 
+# Status codes telling that the session or the secure channel is gone
+CONNECTION_LOST_CODES = {
+    ua.StatusCodes.BadSessionIdInvalid,
+    ua.StatusCodes.BadSessionClosed,
+    ua.StatusCodes.BadSecureChannelClosed,
+    ua.StatusCodes.BadConnectionClosed,
+    ua.StatusCodes.BadServerNotConnected,
+    ua.StatusCodes.BadNotConnected,
+    ua.StatusCodes.BadCommunicationError,
+}
+
+
+def is_connection_lost(exc):
+    """
+    Check if an exception raised by asyncua means that the channel to the server is dead.
+    Args:
+        exc: The exception raised by the client.
+    Returns:
+        True if a new session has to be opened, False if the error only concerns the request.
+    """
+    if isinstance(exc, (ConnectionError, OSError, asyncio.TimeoutError)):
+        return True
+    if isinstance(exc, ua.UaStatusCodeError):
+        return exc.code in CONNECTION_LOST_CODES
+    return False
+
+
+def is_good(datavalue):
+    """
+    Check the status code of a DataValue returned by a read.
+    """
+    return datavalue.StatusCode is None or datavalue.StatusCode.is_good()
+
+
+def get_node_name(nodeid):
+    """
+    Create a readable parameter name from the id of a WS node,
+    e.g. 'ns=2;s=Unit_WS.WS.Monitoring.Air_Temperature.Air_Temperature_v' -> 'Air Temperature'.
+    """
+    return nodeid.to_string().rpartition('.')[2][:-2].replace("_", " ")
+
+
+def format_time(value):
+    """
+    Clean the Time string of the station, e.g. ' 93000' -> '093000'.
+    """
+    value = value.strip()  # remove any leading/trailing spaces
+    if len(value) < 6:
+        value = value.zfill(6)  # pad with leading zeros if necessary
+    return value
+
+
+# Post-processing of the value read from a node, by parameter name
+POSTPROCESS = {"Time": format_time}
+
+# Parameters without which a record has no timestamp
+TIMESTAMP_NODES = ("Date", "Time")
+
+# Node of the WS: its id, the readable parameter name and the post-processing of its value
+WSNode = namedtuple('WSNode', ['nodeid', 'name', 'postprocess'])
+
+
+@lru_cache()
+def load_node_table(path):
+    """
+    Compile the list of WS nodes in DPS.json once, so that it can be shared by all the
+    reading cycles and sessions.
+    Args:
+        path: Path to the DPS.json file.
+    Returns:
+        Tuple of WSNode, in the order of the file.
+    """
+    with open(path, mode="r") as dpsFile:
+        elements = json.load(dpsFile)["Elements"]
+    table = []
+    for element in elements:
+        nodeid = ua.NodeId.from_string("ns=" + element["NS"] + ";s=" + element["Name"])
+        name = get_node_name(nodeid)
+        table.append(WSNode(nodeid, name, POSTPROCESS.get(name)))
+    return tuple(table)
+
 
 class SubHandler(object):
+    """
+    Handler for the subscription to the WS nodes.
+    It keeps the last value of each node and, when the Date/Time of the station changes,
+    hands a complete record to the on_record callback.
+    """
+
+    def __init__(self, on_record=None, settle_time=0.2):
+        """
+        Args:
+            on_record: Function called with the dictionary parameter/value of each new record.
+            settle_time: Seconds to wait after a Date/Time change, so that the values published
+                together with it are in the record too. It should be at least the publishing interval,
+                since they can come in the next cycle.
+        """
+        self.on_record = on_record
+        self.settle_time = settle_time
+        self.nodes = {}  # nodeid -> WSNode, filled when subscribing
+        self.values = {}
+        self.last_timestamp = None
+        self.pending = None
+
     def datachange_notification(self, node, val, data):
         """
         Callback for asyncua Subscription.
         This method will be called when the Client received a data change message from the Server.
         """
-        logger.info(f"New data change notification {node} {val}")
+        logger.debug(f"New data change notification {node} {val}")
+        ws_node = self.nodes.get(node.nodeid)
+        if ws_node is None:
+            return
+        if ws_node.postprocess is not None and val is not None:
+            val = ws_node.postprocess(val)
+        self.values[ws_node.name] = val
+        if ws_node.name in TIMESTAMP_NODES and self.pending is None:
+            self.pending = asyncio.get_running_loop().call_later(self.settle_time, self.emit)
+
+    def emit(self):
+        """
+        Pass the current record to the callback, if its Date/Time is a new one.
+        """
+        self.pending = None
+        timestamp = tuple(self.values.get(node_name) for node_name in TIMESTAMP_NODES)
+        if None in timestamp:
+            logger.error("Date or Time not available. Not possible to have timestamp, so avoid entering it to the DB.")
+            return
+        if timestamp == self.last_timestamp:
+            return
+        self.last_timestamp = timestamp
+        record = {ws_node.name: self.values.get(ws_node.name) for ws_node in self.nodes.values()}
+        if self.on_record is not None:
+            self.on_record(record)
+
+    def reset(self):
+        """
+        Forget the values received, e.g. when the session is lost.
+        """
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+        self.values = {}
 
     def event_notification(self, event):
         print("New event", event)
 
 
 class OPCUAConnection():
-    def __init__(self):
-        self.listOfWSNode = []
+    """
+    Client for the OPC UA server of the WS.
+    The session is opened once and kept alive across the reading cycles. If the channel dies,
+    it is reopened at the next cycle, waiting with an exponential backoff between failed attempts.
+    """
+
+    def __init__(self, min_backoff=1, max_backoff=60, read_mode='bulk', read_timeout=2.):
+        """
+        Args:
+            min_backoff: Seconds to wait after the first failed connection attempt.
+            max_backoff: Maximum seconds to wait between two connection attempts.
+            read_mode: 'bulk' to read all the nodes in one request, 'concurrent' to send one
+                request per node at the same time.
+            read_timeout: Seconds to wait for a read request before considering it failed.
+        """
+        self.nodes = load_node_table(dps_path + "DPS.json")
+        self.nodeids = [node.nodeid for node in self.nodes]
         self.WSDPValues = {}
         host = os.environ.get('OPCUA_HOST', 'localhost')
         port = os.environ.get('OPCUA_PORT')
         self.url = "opc.tcp://" + host + ":" + port
-        with open(dps_path + "DPS.json", mode="r") as dpsFile:
-            dpsDict = json.load(dpsFile)
-            self.dpsList = dpsDict["Elements"]
-            dpsFile.close()
+        self.client = None
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = min_backoff
+        self.next_attempt = 0.  # monotonic time before which no reconnection is tried
+        self.connect_time = 0.  # seconds spent connecting in the last cycle
+        self.read_time = 0.  # seconds spent reading in the last cycle
+        self.max_nodes_per_read = 0  # limit of nodes in one Read request, 0 if none
+        self.subscription = None
+        self.read_mode = read_mode
+        self.read_timeout = read_timeout
 
-    async def connectANDread(self):
-        #start_time = time.time()
+    @property
+    def is_connected(self):
+        return self.client is not None
+
+    async def connect(self):
+        """
+        Open the session with the server, if not already open.
+        Returns:
+            True if the session is open, False if the connection failed or the backoff is not over yet.
+        """
+        if self.client is not None:
+            return True
+        if time.monotonic() < self.next_attempt:
+            return False
+        client = Client(url=self.url)
         try:
-            async with Client(url=self.url) as client:
-                logger.debug('Connected to ', self.url)
-                while True:
-                    for element in self.dpsList:
-                        node = "ns=" + element["NS"] + ";s=" + element["Name"]
-                        var = client.get_node(node)
-                        self.listOfWSNode.append(var)
-
-                    logger.debug("Reading all values")
-                    #read_start_time = time.time()
-                    for nid in self.listOfWSNode:
-                        try:
-                            var = await nid.read_value()
-                            # create more readable name
-                            node_name = nid.nodeid.to_string().rpartition('.')[2][:-2].replace("_", " ")
-                            if node_name == "Time":
-                                var = var.strip()  # remove any leading/trailing spaces
-                                if len(var) < 6:
-                                    var = var.zfill(6)  # pad with leading zeros if necessary
-                            self.WSDPValues[node_name] = var
-                        except Exception:
-                            logger.debug(f"Couldn't read node {nid}")
-                            logger.debug(f"Trying reading node {nid} a second time.")
-                            try:
-                                var = await nid.read_value()
-                                # create more readable name
-                                node_name = nid.nodeid.to_string().rpartition('.')[2][:-2].replace("_", " ")
-                                if node_name == "Time":
-                                    var = var.strip()  # remove any leading/trailing spaces
-                                    if len(var) < 6:
-                                        var = var.zfill(6)  # pad with leading zeros if necessary
-                                self.WSDPValues[node_name] = var
-                            except Exception:
-                                logger.error(f"Second attempt failed for node {nid}")
-                                if nid == "ns=2;s=Unit_WS.WS.Monitoring.Time.Time_v" or nid == "ns=2;s=Unit_WS.WS.Monitoring.Date.Date_v":
-                                    logger.error(f"Couldn't read node {nid}. Not possible to have timestamp, so avoid entering it to the DB.")
-                                    return {}
-                                self.WSDPValues[nid.nodeid.to_string().rpartition('.')[2][:-2].replace("_", " ")] = None
-                    #read_end_time = time.time()
-                    #logger.debug(f"Reading values took {read_end_time - read_start_time} seconds")
-                    #end_time = time.time()
-                    #logger.debug(f"Total elapsed time: {end_time - start_time} seconds")
-                    #logger.debug("Set of WS data: ", self.WSDPValues)
-                    return self.WSDPValues
-        except KeyboardInterrupt:
-            # Handle Ctrl+C (KeyboardInterrupt)
-            logger.info("Received Ctrl+C. Exiting gracefully...")
-            client.disconnect()
+            await client.connect()
         except Exception as e:
-            logger.error(f"Can not connect to OPCUA. Error: {e}")
+            logger.error(f"Can not connect to OPCUA. Error: {e}. Next attempt in {self.backoff}s.")
+            self.next_attempt = time.monotonic() + self.backoff
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            return False
+        self.client = client
+        self.backoff = self.min_backoff
+        try:
+            # 0 means that the server does not limit the nodes read in one request
+            limit = client.get_node(ua.NodeId(ua.ObjectIds.Server_ServerCapabilities_OperationLimits_MaxNodesPerRead))
+            self.max_nodes_per_read = int(await limit.read_value() or 0)
+        except Exception as e:
+            logger.debug(f"Couldn't read the MaxNodesPerRead limit of the server: {e}")
+            self.max_nodes_per_read = 0
+        logger.info(f'Connected to {self.url}')
+        return True
+
+    async def disconnect(self):
+        """
+        Close the session with the server.
+        """
+        if self.client is None:
+            return
+        client, self.client = self.client, None
+        self.subscription = None
+        try:
+            await client.disconnect()
+            logger.info(f'Disconnected from {self.url}')
+        except Exception as e:
+            logger.debug(f"Error while closing the OPCUA session: {e}")
+
+    async def read(self):
+        """
+        Read all the WS nodes, (re)connecting to the server if needed.
+        The time spent in connecting and in reading is stored in connect_time and read_time.
+        Returns:
+            Dictionary with the pair parameter/value of each node, empty if nothing could be read.
+        """
+        start = time.perf_counter()
+        connected = await self.connect()
+        self.connect_time = time.perf_counter() - start
+        self.read_time = 0.
+        if not connected:
+            return {}
+        start = time.perf_counter()
+        try:
+            return await self._read_nodes()
+        except Exception as e:
+            logger.error(f"Lost connection to OPCUA. Error: {e}")
+            await self.disconnect()
+            return {}
+        finally:
+            self.read_time = time.perf_counter() - start
+
+    async def _read_values(self, nodeids):
+        """
+        Read the value attribute of the nodes with a single Read service call,
+        split in chunks if the server limits the number of nodes per request.
+        Args:
+            nodeids: List of NodeId.
+        Returns:
+            List of DataValue, in the same order of the nodes.
+        """
+        results = []
+        while len(results) < len(nodeids):
+            size = self.max_nodes_per_read or len(nodeids)
+            chunk = nodeids[len(results):len(results) + size]
+            try:
+                results.extend(await asyncio.wait_for(
+                    self.client.uaclient.read_attributes(chunk, ua.AttributeIds.Value), self.read_timeout))
+            except ua.UaStatusCodeError as e:
+                if e.code != ua.StatusCodes.BadTooManyOperations or len(chunk) == 1:
+                    raise
+                # the server accepts less nodes than announced, retry with smaller chunks
+                self.max_nodes_per_read = max(len(chunk) // 2, 1)
+                logger.warning(f"Too many nodes in one read, reducing to {self.max_nodes_per_read} nodes per request.")
+        return results
+
+    async def _read_value(self, nodeid):
+        """
+        Read the value attribute of one node, waiting at most read_timeout seconds.
+        Returns:
+            The DataValue of the node.
+        """
+        results = await asyncio.wait_for(
+            self.client.uaclient.read_attributes([nodeid], ua.AttributeIds.Value), self.read_timeout)
+        return results[0]
+
+    async def _read_concurrently(self, indexes, check_channel=True):
+        """
+        Read the nodes at the given indexes of the table, one request per node, all at the same time.
+        Args:
+            indexes: Indexes of the nodes in the node table.
+            check_channel: Consider the channel dead if every request timed out. False for the second
+                attempt, since the server already answered the first one and a few slow nodes are no proof.
+        Returns:
+            List of DataValue, or None for the nodes that could not be read, in the same order of indexes.
+            Raises an exception if the channel to the server is dead.
+        """
+        results = await asyncio.gather(*[self._read_value(self.nodeids[i]) for i in indexes],
+                                       return_exceptions=True)
+        timeouts = 0
+        for i, result in zip(indexes, results):
+            if isinstance(result, asyncio.TimeoutError):
+                timeouts += 1
+                logger.debug(f"Timeout reading node {self.nodeids[i].to_string()}")
+            elif isinstance(result, Exception):
+                if is_connection_lost(result):
+                    raise result
+                logger.debug(f"Couldn't read node {self.nodeids[i].to_string()}: {result}")
+        if check_channel and indexes and timeouts == len(indexes):
+            raise asyncio.TimeoutError(f"No answer from the server within {self.read_timeout}s")
+        return [result if isinstance(result, ua.DataValue) else None for result in results]
+
+    async def _read_nodes(self):
+        """
+        Read the value of all the nodes, in bulk or concurrently depending on read_mode,
+        then try a second time, concurrently, only the ones that failed.
+        Raises the exception if the channel to the server is dead.
+        """
+        logger.debug("Reading all values")
+        if self.read_mode == 'concurrent':
+            first = await self._read_concurrently(range(len(self.nodes)))
+        else:
+            first = await self._read_values(self.nodeids)
+        values = [None] * len(self.nodes)
+        failed = []
+        for i, dv in enumerate(first):
+            if dv is not None and is_good(dv):
+                values[i] = dv.Value.Value
+            else:
+                if dv is not None:
+                    logger.debug(f"Couldn't read node {self.nodeids[i].to_string()}: {dv.StatusCode.name}")
+                failed.append(i)
+        if failed:
+            logger.debug(f"Trying reading {len(failed)} nodes a second time.")
+            retry = await self._read_concurrently(failed, check_channel=False)
+            for i, dv in zip(failed, retry):
+                if dv is not None and is_good(dv):
+                    values[i] = dv.Value.Value
+                    continue
+                status = dv.StatusCode.name if dv is not None else "no answer"
+                logger.error(f"Second attempt failed for node {self.nodeids[i].to_string()}: {status}")
+                if self.nodes[i].name in TIMESTAMP_NODES:
+                    logger.error(f"Couldn't read node {self.nodeids[i].to_string()}. Not possible to have timestamp, so avoid entering it to the DB.")
+                    return {}
+
+        self.WSDPValues = {}
+        for node, var in zip(self.nodes, values):
+            if node.postprocess is not None and var is not None:
+                var = node.postprocess(var)
+            self.WSDPValues[node.name] = var
+        return self.WSDPValues
+
+    async def subscribe(self, handler, period=500):
+        """
+        Subscribe to the data changes of all the WS nodes, (re)connecting to the server if needed.
+        Args:
+            handler: SubHandler receiving the notifications.
+            period: Requested publishing interval in milliseconds.
+        Returns:
+            True if the subscription is active, False otherwise.
+        """
+        if self.subscription is not None:
+            return True
+        if not await self.connect():
+            return False
+        handler.reset()
+        handler.nodes = {node.nodeid: node for node in self.nodes}
+        nodes = [self.client.get_node(nodeid) for nodeid in self.nodeids]
+        try:
+            self.subscription = await self.client.create_subscription(period, handler)
+            results = await self.subscription.subscribe_data_change(nodes)
+        except Exception as e:
+            logger.error(f"Can not subscribe to the WS nodes. Error: {e}")
+            await self.disconnect()
+            return False
+        for nodeid, result in zip(self.nodeids, results):
+            if isinstance(result, ua.StatusCode):
+                logger.error(f"Couldn't subscribe to node {nodeid.to_string()}: {result.name}")
+        logger.info(f"Subscribed to {len(nodes)} nodes, publishing interval {period} ms")
+        return True
+
+    async def check_connection(self):
+        """
+        Check that the session is still alive reading the state of the server.
+        Returns:
+            True if the server answered, False if the session has been closed.
+        """
+        if self.client is None:
+            return False
+        try:
+            await self.client.get_node(ua.NodeId(ua.ObjectIds.Server_ServerStatus_State)).read_value()
+            return True
+        except Exception as e:
+            logger.error(f"Lost connection to OPCUA. Error: {e}")
+            await self.disconnect()
+            return False
+
+    async def connectANDread(self):
+        """
+        Open a session, read all the nodes and close the session.
+        Returns:
+            Dictionary with the pair parameter/value of each node, empty if nothing could be read.
+        """
+        try:
+            return await self.read()
+        finally:
+            await self.disconnect()
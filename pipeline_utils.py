@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('main.pipeline')
+
+
+class FixedRateScheduler:
+    """
+    Class to run the acquisition at a fixed rate.
+    The ticks are on absolute deadlines of the monotonic clock, so the period does not drift with the
+    time taken by each cycle. Ticks missed because a cycle took too long are skipped, not queued.
+    """
+
+    def __init__(self, period, phase=None):
+        """
+        Args:
+            period: Seconds between two ticks.
+            phase: If given, the ticks are aligned to the wall clock, this many seconds after each
+                multiple of the period (e.g. period 10 and phase 0 ticks at :00, :10, :20...).
+        """
+        self.period = period
+        self.phase = phase
+        self.next_tick = None
+        # statistics
+        self.ticks = 0
+        self.overruns = 0  # cycles that took longer than the period
+        self.skipped = 0  # ticks skipped because of the overruns
+        self.last_jitter = 0.  # seconds between the deadline and the actual wake up of the last tick
+        self.max_jitter = 0.
+        self.total_jitter = 0.
+
+    async def wait(self):
+        """
+        Sleep until the next tick.
+        """
+        now = time.monotonic()
+        if self.next_tick is None:
+            self.next_tick = now
+            if self.phase is not None:
+                self.next_tick += (self.phase - time.time()) % self.period
+        else:
+            self.next_tick += self.period
+            if now > self.next_tick:
+                missed = int((now - self.next_tick) // self.period) + 1
+                self.overruns += 1
+                self.skipped += missed
+                self.next_tick += missed * self.period
+                logger.warning(f"Cycle longer than {self.period} s, skipped {missed} ticks "
+                               f"({self.skipped} in {self.overruns} overruns)")
+        await asyncio.sleep(self.next_tick - now)
+        self.ticks += 1
+        self.last_jitter = time.monotonic() - self.next_tick
+        self.max_jitter = max(self.max_jitter, self.last_jitter)
+        self.total_jitter += self.last_jitter
+
+    def stats(self):
+        """
+        Returns:
+            String with the statistics of the ticks.
+        """
+        mean_jitter = self.total_jitter / self.ticks if self.ticks else 0.
+        return (f"tick {self.ticks}, jitter {self.last_jitter * 1000:.1f} ms (mean {mean_jitter * 1000:.1f} ms, "
+                f"max {self.max_jitter * 1000:.1f} ms), {self.overruns} overruns, {self.skipped} skipped ticks")
+
+
+class StationDeduplicator:
+    """
+    Class to recognize the readings already ingested.
+    The station updates its values once per minute, while it is read more often: readings with a
+    Date/Time of the station already seen are duplicates.
+    """
+
+    def __init__(self, keys=("Date", "Time"), size=1000):
+        """
+        Args:
+            keys: Parameters identifying a reading of the station.
+            size: Number of recent readings remembered.
+        """
+        self.keys = keys
+        self.size = size
+        self.seen = OrderedDict()
+        self.suppressed = 0  # duplicated readings found
+
+    def remember(self, key):
+        """
+        Add the key of a reading to the ones already seen.
+        """
+        self.seen[key] = None
+        self.seen.move_to_end(key)
+        if len(self.seen) > self.size:
+            self.seen.popitem(last=False)
+
+    def is_duplicate(self, data):
+        """
+        Check if the reading has already been seen, remembering it if not.
+        Args:
+            data: Dictionary containing the pair parameter/value of the reading.
+        Returns:
+            True if the Date/Time of the reading has already been seen.
+        """
+        key = tuple(data.get(k) for k in self.keys)
+        if key in self.seen:
+            self.suppressed += 1
+            return True
+        self.remember(key)
+        return False
+
+
+class IngestionPipeline:
+    """
+    Class to decouple the acquisition of the WS readings from their storage.
+    The acquisition puts the readings in a bounded queue, while a separate task takes them out and
+    passes them to the WriteBehindBuffer in a worker thread, so that the blocking MongoDB calls
+    never stop the event loop.
+    """
+
+    def __init__(self, buffer, maxsize=100, deduplicator=None):
+        """
+        Args:
+            buffer: WriteBehindBuffer storing the readings.
+            maxsize: Maximum number of readings waiting in the queue.
+            deduplicator: StationDeduplicator to skip the readings already ingested, None to keep all of them.
+        """
+        self.buffer = buffer
+        self.deduplicator = deduplicator
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.task = None
+        # backpressure metrics
+        self.max_depth = 0  # highest number of readings waiting in the queue
+        self.full_count = 0  # times the acquisition found the queue full
+        self.wait_time = 0.  # total seconds the acquisition waited for space in the queue
+        self.store_time = 0.  # seconds taken to store the last reading
+
+    def start(self):
+        """
+        Start the storage task.
+        """
+        self.task = asyncio.create_task(self.storage())
+
+    def check_task(self):
+        """
+        Restart the storage task if it ended unexpectedly, so that the queue does not fill up forever.
+        """
+        if self.task is None or not self.task.done():
+            return
+        error = 'cancelled' if self.task.cancelled() else repr(self.task.exception())
+        logger.error(f"Storage task stopped unexpectedly ({error}), restarting it")
+        self.start()
+
+    async def put(self, data):
+        """
+        Add a reading to the queue, waiting if the queue is full.
+        Args:
+            data: Dictionary containing the pair parameter/value of the reading.
+        """
+        if self.deduplicator is not None and self.deduplicator.is_duplicate(data):
+            logger.debug(f"Reading already stored, skipped ({self.deduplicator.suppressed} duplicates so far)")
+            return
+        self.check_task()
+        if self.queue.full():
+            self.full_count += 1
+            logger.warning(f"Storage queue full ({self.queue.qsize()} readings), acquisition waiting. "
+                           f"Full {self.full_count} times, waited {self.wait_time:.1f} s in total.")
+            start = time.perf_counter()
+            await self.queue.put(data)
+            self.wait_time += time.perf_counter() - start
+        else:
+            self.queue.put_nowait(data)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    async def storage(self):
+        """
+        Pass the readings of the queue to the buffer. If no reading arrives, the buffer is still
+        flushed after its max_delay. The task ends when None is found in the queue.
+        """
+        while True:
+            try:
+                data = await asyncio.wait_for(self.queue.get(), timeout=self.buffer.max_delay)
+            except asyncio.TimeoutError:
+                if self.buffer.documents:
+                    try:
+                        await asyncio.to_thread(self.buffer.flush)
+                    except Exception as e:
+                        logger.error(f"Failed to flush the readings: {e}")
+                continue
+            if data is None:
+                # pipeline closed, everything before has been stored
+                self.queue.task_done()
+                break
+            start = time.perf_counter()
+            try:
+                await asyncio.to_thread(self.buffer.add, data)
+            except Exception as e:
+                logger.error(f"Failed to store the reading: {e}")
+            finally:
+                self.store_time = time.perf_counter() - start
+                self.queue.task_done()
+            logger.debug(f"Reading stored in {self.store_time:.4f} s, {self.queue.qsize()} readings in queue "
+                         f"(max {self.max_depth})")
+
+    async def close(self):
+        """
+        Stop the storage task once the readings left in the queue are stored, then flush the buffer.
+        """
+        if self.task is not None:
+            self.check_task()
+            await self.queue.put(None)
+            await self.task
+            self.task = None
+        await asyncio.to_thread(self.buffer.flush)
@@ -0,0 +1,226 @@
+import logging
+import math
+from datetime import timedelta, timezone
+import numpy as np
+from pymongo import UpdateOne, ReplaceOne
+from layout_utils import COMPACT_KEYS, expand_document
+from bucket_utils import write_new_readings
+
+logger = logging.getLogger('main.rollups')
+
+# Length in seconds of the intervals of the rollups, each one stored in its own collection
+INTERVALS = {'1min': 60, '10min': 600, '1h': 3600}
+
+# Rollup documents summarize the readings of one interval:
+# {
+#     "_id": datetime of the start of the interval (UTC),
+#     "count": number of readings,
+#     "timestamps": [timestamp of each reading],
+#     short key: {"min": v, "max": v, "sum": v, "count": n},
+#     "wind_dir": {"sin": v, "cos": v, "count": n},
+# }
+# The mean is sum/count; the direction is averaged as a vector, from the sums of its sine and cosine.
+
+# Parameters which are not numeric measurements
+EXCLUDED = ("Date", "Time", "Precipitation Type")
+# Parameters in degrees, averaged as vectors
+DIRECTIONS = ("Mean Wind Direction",)
+
+
+def interval_start(timestamp, seconds):
+    """
+    Get the start of the interval of a timestamp, used as _id of its rollup.
+    Args:
+        timestamp: Datetime of the reading.
+        seconds: Length of the interval, a divisor of one hour.
+    """
+    offset = (timestamp.minute * 60 + timestamp.second) % seconds
+    return timestamp.replace(microsecond=0) - timedelta(seconds=offset)
+
+
+def numeric_values(doc):
+    """
+    Get the numeric values of a reading which are rolled up.
+    Args:
+        doc: Document of the reading, in either layout.
+    Returns:
+        Dictionary with the name and the value of each parameter.
+    """
+    values = {}
+    for name, value in expand_document(doc).items():
+        if name in EXCLUDED or not isinstance(value, dict):
+            continue
+        value = value.get('value')
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and not math.isnan(value):
+            values[name] = value
+    return values
+
+
+def rollup_update(doc, seconds):
+    """
+    Create the update adding a reading to the rollup of its interval.
+    If the timestamp is already in the rollup, the filter does not match and the upsert fails with a
+    duplicate key, so that a reading written twice is not counted twice.
+    Args:
+        doc: Document of the reading, in either layout.
+        seconds: Length of the interval.
+    Returns:
+        The UpdateOne request, or None if the reading has no timestamp.
+    """
+    timestamp = doc.get('timestamp')
+    if timestamp is None:
+        return None
+    increment = {'count': 1}
+    minimum = {}
+    maximum = {}
+    for name, value in numeric_values(doc).items():
+        key = COMPACT_KEYS.get(name, name)
+        increment[key + '.count'] = 1
+        if name in DIRECTIONS:
+            increment[key + '.sin'] = math.sin(math.radians(value))
+            increment[key + '.cos'] = math.cos(math.radians(value))
+        else:
+            increment[key + '.sum'] = value
+            minimum[key + '.min'] = value
+            maximum[key + '.max'] = value
+    update = {'$push': {'timestamps': timestamp}, '$inc': increment}
+    if minimum:
+        update['$min'] = minimum
+        update['$max'] = maximum
+    return UpdateOne({'_id': interval_start(timestamp, seconds), 'timestamps': {'$ne': timestamp}}, update, upsert=True)
+
+
+def update_rollups(collections, documents):
+    """
+    Add the readings to the rollups of each interval, with a single request per interval.
+    Args:
+        collections: Dictionary with the collection of each interval, keys of INTERVALS.
+        documents: Documents of the readings, in either layout.
+    """
+    for interval, collection in collections.items():
+        seconds = INTERVALS[interval]
+        write_new_readings(collection, [request for request in (rollup_update(doc, seconds) for doc in documents)
+                                        if request is not None])
+
+
+def new_rollup(start):
+    """
+    Create an empty rollup document.
+    """
+    return {'_id': start, 'count': 0, 'timestamps': []}
+
+
+def add_to_rollup(rollup, doc):
+    """
+    Add a reading to a rollup document in memory, with the same result as rollup_update.
+    """
+    rollup['count'] += 1
+    rollup['timestamps'].append(doc['timestamp'])
+    for name, value in numeric_values(doc).items():
+        key = COMPACT_KEYS.get(name, name)
+        if name in DIRECTIONS:
+            summary = rollup.setdefault(key, {'sin': 0., 'cos': 0., 'count': 0})
+            summary['sin'] += math.sin(math.radians(value))
+            summary['cos'] += math.cos(math.radians(value))
+        else:
+            summary = rollup.setdefault(key, {'min': value, 'max': value, 'sum': 0., 'count': 0})
+            summary['min'] = min(summary['min'], value)
+            summary['max'] = max(summary['max'], value)
+            summary['sum'] += value
+        summary['count'] += 1
+
+
+def rebuild_rollups(readings, collections, start=None, batch_size=1000):
+    """
+    Compute again the rollups from the readings, e.g. for the historical data or after a change of
+    the readings. The readings are read in time order, so that each rollup is complete when the next
+    interval starts and is written with a single replace.
+    Args:
+        readings: Collection of the readings.
+        collections: Dictionary with the collection of each interval, keys of INTERVALS.
+        start: Rebuild only from this datetime, rounded down to the hour. From the oldest reading still in
+            the collection if None, so that the rollups of the archived readings are kept.
+        batch_size: Number of rollups written with each request.
+    Returns:
+        Dictionary with the number of rollups written for each interval.
+    """
+    if start is None:
+        oldest = readings.find_one({'timestamp': {'$type': 'date'}}, {'timestamp': 1}, sort=[('timestamp', 1)])
+        if oldest is None:
+            return {interval: 0 for interval in collections}
+        start = oldest['timestamp']
+    start = interval_start(start, 3600)
+    query = {'timestamp': {'$gte': start}}
+    for collection in collections.values():
+        collection.delete_many({'_id': {'$gte': start}})
+    current = {interval: None for interval in collections}
+    requests = {interval: [] for interval in collections}
+    written = {interval: 0 for interval in collections}
+
+    def write(interval, force=False):
+        if requests[interval] and (force or len(requests[interval]) >= batch_size):
+            collections[interval].bulk_write(requests[interval], ordered=False)
+            written[interval] += len(requests[interval])
+            requests[interval] = []
+
+    cursor = readings.find(query, batch_size=batch_size).sort('timestamp', 1)
+    for count, doc in enumerate(cursor, start=1):
+        for interval in collections:
+            rollup = current[interval]
+            doc_start = interval_start(doc['timestamp'], INTERVALS[interval])
+            if rollup is None or rollup['_id'] != doc_start:
+                if rollup is not None:
+                    requests[interval].append(ReplaceOne({'_id': rollup['_id']}, rollup, upsert=True))
+                    write(interval)
+                rollup = current[interval] = new_rollup(doc_start)
+            if not rollup['timestamps'] or rollup['timestamps'][-1] != doc['timestamp']:
+                add_to_rollup(rollup, doc)
+        if count % (10 * batch_size) == 0:
+            logger.info(f'### {count} readings rolled up')
+    for interval, rollup in current.items():
+        if rollup is not None:
+            requests[interval].append(ReplaceOne({'_id': rollup['_id']}, rollup, upsert=True))
+        write(interval, force=True)
+    logger.info(f"### Rollups written: {written}")
+    return written
+
+
+def read_rollups(collection, start, end, names):
+    """
+    Read the rollups of a time range.
+    Args:
+        collection: Collection of the rollups of one interval.
+        start: Start of the range (UTC datetime).
+        end: End of the range (UTC datetime).
+        names: Names of the parameters, e.g. 'Air Temperature'.
+    Returns:
+        Tuple with the array of the start of each interval (datetime64[ms], UTC), the array of the number
+        of readings and a dictionary with the arrays of min, max, mean and count of each parameter, NaN
+        where the parameter has no values. Directions have only mean and count.
+    """
+    keys = {name: COMPACT_KEYS.get(name, name) for name in names}
+    projection = {'count': 1}
+    for key in keys.values():
+        projection[key] = 1
+    rollups = list(collection.find({'_id': {'$gte': start, '$lte': end}}, projection, sort=[('_id', 1)]))
+    times = np.array([r['_id'].replace(tzinfo=None) if r['_id'].tzinfo is None
+                      else r['_id'].astimezone(timezone.utc).replace(tzinfo=None) for r in rollups],
+                     dtype='datetime64[ms]')
+    counts = np.array([r.get('count', 0) for r in rollups], dtype=int)
+    summaries = {}
+    for name, key in keys.items():
+        summary = [r.get(key, {}) for r in rollups]
+        count = np.array([s.get('count', 0) for s in summary], dtype=float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if name in DIRECTIONS:
+                sin = np.array([s.get('sin', np.nan) for s in summary], dtype=float)
+                cos = np.array([s.get('cos', np.nan) for s in summary], dtype=float)
+                summaries[name] = {'mean': np.degrees(np.arctan2(sin, cos)) % 360, 'count': count}
+            else:
+                summaries[name] = {
+                    'min': np.array([s.get('min', np.nan) for s in summary], dtype=float),
+                    'max': np.array([s.get('max', np.nan) for s in summary], dtype=float),
+                    'mean': np.array([s.get('sum', np.nan) for s in summary], dtype=float) / count,
+                    'count': count,
+                }
+    return times, counts, summaries
@@ -2,8 +2,10 @@ from datetime import time as t
 import asyncio
 import logging
 from logging.handlers import TimedRotatingFileHandler
-from mongo_utils import MongoDB
-from opcua_utils import OPCUAConnection
+from mongo_utils import MongoDB, WriteBehindBuffer
+from pipeline_utils import IngestionPipeline, FixedRateScheduler, StationDeduplicator
+from opcua_utils import OPCUAConnection, SubHandler
+from index_utils import ensure_indexes_safe
 import signal
 import os
 from dotenv import load_dotenv
@@ -11,6 +13,22 @@ from dotenv import load_dotenv
 # Load environment variables from the .env file in the root directory
 load_dotenv()
 log_path = os.environ.get('OPCUA_LOG_PATH')
+poll_interval = float(os.environ.get('OPCUA_POLL_INTERVAL', 10))  # seconds between two readings of the WS
+poll_phase = os.environ.get('OPCUA_POLL_PHASE')  # if set, read at this many seconds after each multiple of poll_interval
+poll_phase = float(poll_phase) if poll_phase else None
+mode = os.environ.get('OPCUA_MODE', 'poll')  # 'poll' or 'subscription'
+publishing_interval = float(os.environ.get('OPCUA_PUBLISHING_INTERVAL', 500))  # ms, only in subscription mode
+read_mode = os.environ.get('OPCUA_READ_MODE', 'bulk')  # 'bulk' or 'concurrent'
+read_timeout = float(os.environ.get('OPCUA_READ_TIMEOUT', 2))  # seconds to wait for each read request
+batch_size = int(os.environ.get('DB_BATCH_SIZE', 10))  # readings written to MongoDB with one request
+max_delay = float(os.environ.get('DB_MAX_DELAY', 30))  # max seconds a reading waits before being written
+spool_path = os.environ.get('SPOOL_PATH', './') + 'WS_spool.jsonl'  # readings kept here while MongoDB is down
+queue_size = int(os.environ.get('QUEUE_SIZE', 100))  # readings waiting to be stored before the acquisition is slowed down
+deduplicate = os.environ.get('DEDUPLICATE', '1') == '1'  # store only one reading for each Date/Time of the station
+sources = os.environ.get('WS_SOURCES', 'opcua').replace(' ', '').split(',')  # 'opcua', 'modbus' or both
+modbus_host = os.environ.get('MODBUS_HOST', '10.1.101.77')
+modbus_port = int(os.environ.get('MODBUS_PORT', 502))
+modbus_max_gap = int(os.environ.get('MODBUS_MAX_GAP', 8))  # unused registers read to merge two blocks
 
 #---------------------------------------------------------------------------#
 # Initialize the main logger
@@ -26,32 +44,92 @@ file_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
 
 
+async def store(pipeline, data):
+    """
+    Pass the data to the storage task
+    """
+    if data:
+        await pipeline.put(data)
+    else:
+        logger.debug("No data available. Skipping add it to Mongo!")
+
+
+async def poll(ws, pipeline, name='OPC UA'):
+    """
+    Read all the WS values from the source (OPCUAConnection or ModbusConnection) every poll_interval seconds.
+    """
+    scheduler = FixedRateScheduler(poll_interval, phase=poll_phase)
+    while True:
+        # sleep until the next pulling
+        await scheduler.wait()
+        data = await ws.read()
+        logger.debug(f"{name} connect: {ws.connect_time:.4f} s, read: {ws.read_time:.4f} s, {scheduler.stats()}")
+        await store(pipeline, data)
+
+
+async def subscribe(ws, pipeline):
+    """
+    Subscribe to the WS nodes and store a record each time the station Date/Time changes.
+    The connection is checked every poll_interval seconds without new records.
+    """
+    records = asyncio.Queue()
+    # the values changed together with the Date/Time can come in the next publishing cycle
+    handler = SubHandler(on_record=records.put_nowait, settle_time=publishing_interval / 1000)
+    while True:
+        if not await ws.subscribe(handler, period=publishing_interval):
+            await asyncio.sleep(poll_interval)
+            continue
+        try:
+            data = await asyncio.wait_for(records.get(), timeout=poll_interval)
+        except asyncio.TimeoutError:
+            await ws.check_connection()
+            continue
+        await store(pipeline, data)
+
+
 async def main():
+    # Keep the same OPC UA session and Modbus connection across the cycles, they are reopened only if they die
+    ws = OPCUAConnection(read_mode=read_mode, read_timeout=read_timeout) if 'opcua' in sources else None
+    modbus = None
+    if 'modbus' in sources:
+        # pymodbus (and astropy) are needed only to read the Modbus source
+        from modbus.WS_utils import ModbusConnection
+        modbus = ModbusConnection(host=modbus_host, port=modbus_port, max_gap=modbus_max_gap)
+    # Same for MongoDB, the client keeps a pool of connections for all the insertions
+    mongo = MongoDB()
+    ensure_indexes_safe(mongo.measurements_col, 'readings')
+    if mongo.buckets_col is not None:
+        ensure_indexes_safe(mongo.buckets_col, 'buckets')
+    buffer = WriteBehindBuffer(mongo, batch_size=batch_size, max_delay=max_delay, spool_path=spool_path)
+    # Acquisition (this task) and storage (pipeline task) are connected by a bounded queue
+    # Skip the readings with a station Date/Time already stored, starting from the latest one in the DB
+    deduplicator = None
+    if deduplicate:
+        deduplicator = StationDeduplicator()
+        latest = mongo.get_latest(deduplicator.keys)
+        if latest is not None:
+            deduplicator.remember(latest)
+    pipeline = IngestionPipeline(buffer, maxsize=queue_size, deduplicator=deduplicator)
+    pipeline.start()
+    # Both sources put their readings in the same pipeline
+    tasks = []
+    if ws is not None:
+        tasks.append(subscribe(ws, pipeline) if mode == 'subscription' else poll(ws, pipeline))
+    if modbus is not None:
+        tasks.append(poll(modbus, pipeline, name='Modbus'))
     try:
-        while True:
-            #start_ws = time.perf_counter()
-            ws = OPCUAConnection()
-            data = await ws.connectANDread()
-            #end_ws = time.perf_counter()
-            #logger.debug(f"Time taken for OPC UA connection and read: {end_ws - start_ws:.4f} seconds")
-            # Connect to MongoDB and insert the data
-            if data:
-                #start_mongo = time.perf_counter()
-                mongo = MongoDB()
-                mongo.insert(data)
-                mongo.close_connection()
-                #end_mongo = time.perf_counter()
-                #logger.debug(f"Time taken for MongoDB conect and insert: {end_mongo - start_mongo:.4f} seconds")
-            else:
-                logger.debug("No data available. Skipping add it to Mongo!")
-            # sleep 10s before next pulling
-            #time.sleep(10)
-            await asyncio.sleep(10)
+        await asyncio.gather(*tasks)
     except KeyboardInterrupt:
         # Handle Ctrl+C (KeyboardInterrupt)
         logger.info("Received Ctrl+C. Exiting gracefully...")
     except Exception as e:
         logger.error(f"An error occurred: {e}")
+    finally:
+        for source in (ws, modbus):
+            if source is not None:
+                await source.disconnect()
+        await pipeline.close()
+        mongo.close_connection()
 
 if __name__ == "__main__":
     # Set up a signal handler for SIGINT (Ctrl+C)
@@ -0,0 +1,66 @@
+import asyncio
+import os
+import sys
+import pytest
+
+pytest.importorskip('asyncua')
+pytest.importorskip('dotenv')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from asyncua import ua  # noqa: E402
+import opcua_utils  # noqa: E402
+
+VALUES = {'Date': '20240101', 'Time': ' 93000'}
+
+
+class FakeUaClient:
+    """
+    Answers the reads as the server would, with a Bad status in the bulk read and no answer to the
+    single reads for the nodes in slow.
+    """
+
+    def __init__(self, slow):
+        self.slow = slow
+
+    async def read_attributes(self, nodeids, attribute):
+        names = [opcua_utils.get_node_name(nodeid) for nodeid in nodeids]
+        if len(nodeids) == 1 and names[0] in self.slow:
+            await asyncio.sleep(10)
+        return [ua.DataValue(ua.Variant(VALUES.get(name, 1.0)),
+                             StatusCode=ua.StatusCode(ua.StatusCodes.BadWaitingForInitialData if name in self.slow
+                                                      else ua.StatusCodes.Good))
+                for name in names]
+
+
+class FakeClient:
+
+    def __init__(self, slow):
+        self.uaclient = FakeUaClient(slow)
+        self.disconnected = False
+
+    async def disconnect(self):
+        self.disconnected = True
+
+
+def make_connection(monkeypatch, slow):
+    monkeypatch.setenv('OPCUA_PORT', '4840')
+    monkeypatch.setattr(opcua_utils, 'dps_path', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', ''))
+    connection = opcua_utils.OPCUAConnection(read_timeout=0.05)
+    client = FakeClient(slow)
+    connection.client = client
+    return connection, client
+
+
+def test_slow_node_on_retry_is_stored_as_none(monkeypatch):
+    connection, client = make_connection(monkeypatch, {'Brightness'})
+    values = asyncio.run(connection.read())
+    assert values['Brightness'] is None
+    assert values['Air Temperature'] == 1.0
+    assert values['Time'] == '093000'
+    # the session is kept
+    assert connection.is_connected and not client.disconnected
+
+
+def test_slow_timestamp_node_drops_the_record(monkeypatch):
+    connection, client = make_connection(monkeypatch, {'Date'})
+    assert asyncio.run(connection.read()) == {}
+    assert connection.is_connected and not client.disconnected
@@ -0,0 +1,90 @@
+import os
+import sys
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+
+# the dashboard modules import the dashboard dependencies
+pytest.importorskip('dash')
+pytest.importorskip('dash_bootstrap_components')
+pytest.importorskip('bs4')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dashboard'))
+from utils_functions import handle_data_gaps  # noqa: E402
+
+
+def loop_data_gaps(timestamps, *data_lists, max_time_diff=120):
+    """
+    The previous handle_data_gaps loop, with each value kept with its own timestamp.
+    """
+    new_data = [[data[0]] for data in data_lists]
+    new_timestamps = [timestamps[0]]
+    prev_timestamp = timestamps[0]
+    for timestamp, *values in zip(timestamps[1:], *[data[1:] for data in data_lists]):
+        if abs((timestamp - prev_timestamp).total_seconds()) >= max_time_diff:
+            new_timestamps.append(None)
+            for data in new_data:
+                data.append(None)
+        new_timestamps.append(timestamp)
+        for data, value in zip(new_data, values):
+            data.append(value)
+        prev_timestamp = timestamp
+    return new_timestamps, *new_data
+
+
+def random_readings(seed, n=2000):
+    """
+    Readings every 10 s with random gaps, including one after the first reading, one before the last
+    reading, consecutive gaps and differences just below and at the limit.
+    """
+    rng = np.random.default_rng(seed)
+    steps = np.where(rng.random(n - 1) < 0.05, rng.choice([119, 120, 121, 600, 3600], n - 1), 10)
+    steps[0] = 300
+    steps[-1] = 900
+    steps[10:13] = 150
+    start = datetime(2024, 1, 1)
+    timestamps = [start]
+    for step in steps:
+        timestamps.append(timestamps[-1] + timedelta(seconds=int(step)))
+    return timestamps, rng.random(n) * 30, rng.random(n) * 100
+
+
+def assert_same(result, expected):
+    assert list(result[0]) == expected[0]
+    for values, expected_values in zip(result[1:], expected[1:]):
+        np.testing.assert_array_equal(values, np.array(expected_values, dtype=float))
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('order', [1, -1])  # oldest or newest first
+def test_same_as_loop(seed, order):
+    timestamps, temps, hums = random_readings(seed)
+    timestamps, temps, hums = timestamps[::order], temps[::order], hums[::order]
+    result = handle_data_gaps(np.array(timestamps, dtype=object), temps, hums)
+    expected = loop_data_gaps(timestamps, list(temps), list(hums))
+    assert_same(result, expected)
+    gaps = [i for i, timestamp in enumerate(result[0]) if timestamp is None]
+    assert gaps[0] == 1 and gaps[-1] == len(result[0]) - 2
+    assert all(np.isnan(result[1][gaps])) and all(np.isnan(result[2][gaps]))
+
+
+def test_values_keep_their_timestamp():
+    # the previous loop zipped timestamps[1:] with the whole data lists, shifting the values by one
+    start = datetime(2024, 1, 1)
+    timestamps = [start, start + timedelta(seconds=10), start + timedelta(seconds=300), start + timedelta(seconds=310)]
+    new_timestamps, values = handle_data_gaps(timestamps, [0., 1., 2., 3.])
+    assert list(new_timestamps) == [timestamps[0], timestamps[1], None, timestamps[2], timestamps[3]]
+    np.testing.assert_array_equal(values, [0., 1., np.nan, 2., 3.])
+
+
+def test_short_and_missing():
+    start = datetime(2024, 1, 1)
+    new_timestamps, values = handle_data_gaps([], [])
+    assert len(new_timestamps) == 0 and len(values) == 0
+    new_timestamps, values = handle_data_gaps([start], [1.])
+    assert list(new_timestamps) == [start]
+    np.testing.assert_array_equal(values, [1.])
+    # a missing timestamp is not a gap, a missing value is NaN
+    new_timestamps, values = handle_data_gaps([start, None, start + timedelta(seconds=10)], [1., None, 3.])
+    assert list(new_timestamps) == [start, None, start + timedelta(seconds=10)]
+    np.testing.assert_array_equal(values, [1., np.nan, 3.])
@@ -0,0 +1,37 @@
+import os
+import logging
+import argparse
+from mongo_utils import MongoDB
+from archive_utils import archive_readings
+
+# Move the old readings from MongoDB to Parquet files (see archive_utils.py).
+# Run it from the root folder, e.g. once per day from cron: python -m utils.archive_readings
+# The folder, the age and the partition are read from the .env file (ARCHIVE_PATH, ARCHIVE_MAX_AGE_DAYS,
+# ARCHIVE_PARTITION) and can be overridden by the options.
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s : %(message)s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive the old readings to Parquet files.')
+    parser.add_argument('--path', default=os.environ.get('ARCHIVE_PATH', './archive/'), help='folder of the Parquet files')
+    parser.add_argument('--max-age-days', type=float, default=float(os.environ.get('ARCHIVE_MAX_AGE_DAYS', 90)),
+                        help='readings older than this are archived')
+    parser.add_argument('--partition', choices=['day', 'month'], default=os.environ.get('ARCHIVE_PARTITION', 'day'),
+                        help='period of the readings stored in each file')
+    parser.add_argument('--batch-size', type=int, default=1000, help='readings deleted with each request')
+    args = parser.parse_args()
+
+    mongo = MongoDB()
+    try:
+        before = mongo.collection_stats()
+        archive_readings(mongo.measurements_col, args.path, args.max_age_days, partition=args.partition,
+                         batch_size=args.batch_size)
+        after = mongo.collection_stats()
+        print(f"Readings in MongoDB: {before['count']} -> {after['count']}")
+    finally:
+        mongo.close_connection()
+
+
+if __name__ == "__main__":
+    main()
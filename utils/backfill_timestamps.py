@@ -0,0 +1,24 @@
+import logging
+import argparse
+from mongo_utils import MongoDB
+
+# Add the datetime of the station (field 'timestamp') to the readings stored before it was
+# computed at insert time. Run it from the root folder: python -m utils.backfill_timestamps
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s : %(message)s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Add the station timestamp to the readings stored without it.')
+    parser.add_argument('--batch-size', type=int, default=1000, help='documents updated with each request')
+    args = parser.parse_args()
+
+    mongo = MongoDB()
+    try:
+        mongo.backfill_timestamps(batch_size=args.batch_size)
+    finally:
+        mongo.close_connection()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import sys
+import logging
+import argparse
+from mongo_utils import MongoDB
+from index_utils import ensure_indexes, check_query_plans
+
+# Check that every query shape of the WS client, the dashboard and the API uses an index (see index_utils.py).
+# Run it from the root folder: python -m utils.check_indexes
+# The exit code is 1 if any query scans the whole collection (COLLSCAN).
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s : %(message)s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the query plans of the weather data.')
+    parser.add_argument('--create', action='store_true', help='create the missing indexes before the check')
+    args = parser.parse_args()
+
+    mongo = MongoDB()
+    try:
+        collections = {'readings': mongo.measurements_col, 'buckets': mongo.buckets_col,
+                       'rollups': mongo.rollup_cols.get('1h')}
+        if args.create:
+            for kind, collection in collections.items():
+                if collection is not None:
+                    ensure_indexes(collection, kind)
+        plans = check_query_plans(collections)
+    finally:
+        mongo.close_connection()
+
+    failed = [name for name, stages in plans.items() if 'COLLSCAN' in stages]
+    for name, stages in plans.items():
+        print(f"{'FAIL' if name in failed else 'OK':4} {name}: {' > '.join(stages)}")
+    if failed:
+        print(f"{len(failed)} queries do a collection scan: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+import logging
+import argparse
+from mongo_utils import MongoDB
+
+# Add the readings already stored to the hourly buckets (see bucket_utils.py).
+# Set DB_BUCKETS in the .env file to the name of the collection of the buckets, then run it from the
+# root folder: python -m utils.fill_buckets
+# It can be run while the WS is ingesting, the readings already in their bucket are skipped.
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s : %(message)s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Add the stored readings to the hourly buckets.')
+    parser.add_argument('--batch-size', type=int, default=1000, help='readings appended with each request')
+    args = parser.parse_args()
+
+    mongo = MongoDB()
+    try:
+        mongo.fill_buckets(batch_size=args.batch_size)
+    finally:
+        mongo.close_connection()
+
+
+if __name__ == "__main__":
+    main()
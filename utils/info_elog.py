@@ -7,6 +7,10 @@ from dotenv import load_dotenv
 import os
 import requests
 import xml.etree.ElementTree as ET
+import sys
+# modules shared with the WS client, in the root folder of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from layout_utils import expand_document  # noqa: E402
 
 
 # Load environment variables from the .env
@@ -97,7 +101,7 @@ if opcua_var == 'N/A':
     print("WARNING!!!! Error retrieving OPC UA variable.")
 
 # Move to the WS DB and find the most recent doc
-most_recent_doc = collection_ws.find_one({}, sort=[("_id", pymongo.DESCENDING)])
+most_recent_doc = expand_document(collection_ws.find_one({}, sort=[("_id", pymongo.DESCENDING)]))
 # Extract date and time values from the document
 date_str = most_recent_doc["Date"]["value"]
 time_str = most_recent_doc["Time"]["value"]
@@ -0,0 +1,33 @@
+import logging
+import argparse
+from mongo_utils import MongoDB
+from ingest_utils import read_file, validate, load_readings
+
+# Load readings in bulk from CSV, Parquet or JSON-lines files (see ingest_utils.py), e.g. a spool file,
+# an export of the API or the readings of another station.
+# Run it from the root folder: python -m utils.load_readings file [file ...]
+# Readings whose station Date/Time is already stored are skipped, so a file can be loaded again.
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s : %(message)s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load readings in bulk.')
+    parser.add_argument('files', nargs='+', help='files to load')
+    parser.add_argument('--format', choices=['csv', 'parquet', 'jsonl'], help='format of the files, from the extension if not given')
+    parser.add_argument('--batch-size', type=int, default=1000, help='readings inserted with each request')
+    parser.add_argument('--dry-run', action='store_true', help='only check the files')
+    args = parser.parse_args()
+
+    mongo = MongoDB()
+    try:
+        for path in args.files:
+            df = validate(read_file(path, args.format), mongo.parameters)
+            inserted, skipped = load_readings(mongo, df, batch_size=args.batch_size, dry_run=args.dry_run)
+            print(f"{path}: {inserted} readings {'to insert' if args.dry_run else 'inserted'}, {skipped} already stored")
+    finally:
+        mongo.close_connection()
+
+
+if __name__ == "__main__":
+    main()
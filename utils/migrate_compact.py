@@ -0,0 +1,31 @@
+import logging
+import argparse
+from mongo_utils import MongoDB
+
+# Convert the Readings collection to the compact layout (see layout_utils.py).
+# Run it from the root folder: python -m utils.migrate_compact
+# Then set DB_LAYOUT = compact in the .env file, so that the new readings are stored in the same layout.
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s : %(message)s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert the readings to the compact layout.')
+    parser.add_argument('--batch-size', type=int, default=1000, help='documents replaced with each request')
+    args = parser.parse_args()
+
+    mongo = MongoDB()
+    try:
+        before = mongo.collection_stats()
+        print(f"Before: {before}")
+        mongo.migrate_to_compact(batch_size=args.batch_size)
+        after = mongo.collection_stats()
+        print(f"After: {after}")
+        if before['size'] and after['size']:
+            print(f"Data size reduced by {100 * (1 - after['size'] / before['size']):.1f} %")
+    finally:
+        mongo.close_connection()
+
+
+if __name__ == "__main__":
+    main()
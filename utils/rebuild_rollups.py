@@ -0,0 +1,30 @@
+import logging
+import argparse
+from datetime import datetime, timezone
+from mongo_utils import MongoDB
+
+# Compute again the rollups of the readings (see rollup_utils.py), e.g. for the historical data.
+# Set DB_ROLLUPS in the .env file to the prefix of the collections of the rollups, then run it from the
+# root folder: python -m utils.rebuild_rollups [--since YYYY-MM-DD]
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s : %(message)s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the rollups of the readings.')
+    parser.add_argument('--since', help='rebuild only from this date (YYYY-MM-DD), all the readings if not given')
+    parser.add_argument('--batch-size', type=int, default=1000, help='rollups written with each request')
+    args = parser.parse_args()
+    start = datetime.strptime(args.since, '%Y-%m-%d').replace(tzinfo=timezone.utc) if args.since else None
+
+    mongo = MongoDB()
+    try:
+        written = mongo.rebuild_rollups(start=start, batch_size=args.batch_size)
+        for interval, count in written.items():
+            print(f"{interval}: {count} rollups")
+    finally:
+        mongo.close_connection()
+
+
+if __name__ == "__main__":
+    main()
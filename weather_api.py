@@ -3,8 +3,13 @@ from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime, timezone
 import pymongo
+import numpy as np
 import os
 from dotenv import load_dotenv
+from index_utils import ensure_indexes_safe
+from rollup_utils import INTERVALS, read_rollups
+from archive_utils import find_readings
+from layout_utils import PARAMETER_NAMES
 
 # Load environment variables from .env file
 load_dotenv("../.env")
@@ -15,42 +20,23 @@ port_ws_db = os.environ.get('DB_PORT')
 uri_ws = f"mongodb://{host_ws_db}:{port_ws_db}"
 dbName_ws = os.environ.get('DB_NAME')
 collectionName_ws = os.environ.get('DB_COLL')
+rollups_ws = os.environ.get('DB_ROLLUPS')
+archive_path = os.environ.get('ARCHIVE_PATH')  # Parquet files of the old readings, see archive_utils
+archive_partition = os.environ.get('ARCHIVE_PARTITION', 'day')
 
 client_ws = pymongo.MongoClient(uri_ws)
 db_ws = client_ws[dbName_ws]
 collection_ws = db_ws[collectionName_ws]
+rollup_cols_ws = {interval: db_ws[f"{rollups_ws}_{interval}"] for interval in INTERVALS} if rollups_ws else {}
 
-# # Create indexes for Date and Time fields to improve query performance
-# if not collection_ws.index_information().get("Date.value"):
-#     collection_ws.create_index([("Date.value", pymongo.ASCENDING)])
-# if not collection_ws.index_information().get("Time.value"):
-#     collection_ws.create_index([("Time.value", pymongo.ASCENDING)])
+# Create the indexes needed by the queries, if missing
+ensure_indexes_safe(collection_ws, 'readings')
 
 # FastAPI app initialization
 app = FastAPI()
 
-# Define available weather parameters and their short names
-PARAM_MAP = {
-    "temp": "Air Temperature",
-    "hum": "Relative Humidity",
-    "pres": "Absolute Air Pressure",
-    "abs_hum": "Absolute Humidity",
-    "avg_wind": "Average Wind Speed",
-    "mean_wind": "Mean Wind Speed",
-    "wind_dir": "Mean Wind Direction",
-    "gust": "Max Wind",
-    "bright": "Brightness",
-    "bright_lux": "Brightness lux",
-    "dew_point": "Dew Point Temperature",
-    "glob_rad": "Global Radiation",
-    "heat_idx": "Heat Index Temperature",
-    "wind_chill": "Wind Chill Temperature",
-    "precip_status": "Precipitation Status",
-    "precip_amt": "Precipitation Amount",
-    "precip_int": "Precipitation Intensity",
-    "precip_type": "Precipitation Type",
-    "wind_10": "Mean 10 Wind Speed"
-}
+# Define available weather parameters and their short names, the keys of the compact layout
+PARAM_MAP = {short: name for short, name in PARAMETER_NAMES.items() if name not in ("Date", "Time")}
 
 AVAILABLE_PARAMS = list(PARAM_MAP.keys()) + ["all"]
 
@@ -79,6 +65,32 @@ class WeatherRequest(BaseModel):
     end: Optional[str] = None
     params: List[str]
     output: Optional[str] = "weather_data.csv"
+    interval: Optional[str] = None  # '1min', '10min' or '1h' to get the mean/min/max of each interval
+
+
+def get_rollup_data(request, start_dt, end_dt):
+    """
+    Get the mean, min and max of the parameters in each interval from the rollups, with the number of readings
+    of the interval, so that the means can be weighted.
+    """
+    if request.interval not in rollup_cols_ws:
+        raise HTTPException(status_code=400, detail=f"Interval not available, use one of: {list(rollup_cols_ws)}")
+    names = {short_name: full_name for short_name, full_name in PARAM_MAP.items()
+             if "all" in request.params or short_name in request.params}
+    times, counts, summaries = read_rollups(rollup_cols_ws[request.interval], start_dt, end_dt, list(names.values()))
+    weather_data = []
+    for i, interval_start in enumerate(times.astype(datetime)):
+        entry = {"DateTime": interval_start.strftime("%Y-%m-%d %H:%M:%S"), "count": int(counts[i])}
+        for short_name, full_name in names.items():
+            if full_name not in summaries:
+                continue
+            for stat, values in summaries[full_name].items():
+                if stat == "count" or np.isnan(values[i]):
+                    continue
+                key = short_name if stat == "mean" else f"{short_name}_{stat}"
+                entry[key] = round(float(values[i]), 2)
+        weather_data.append(entry)
+    return weather_data
 
 
 @app.post("/weather")
@@ -86,27 +98,21 @@ def get_weather_data(request: WeatherRequest):
     start_dt = parse_datetime(request.start)
     end_dt = parse_datetime(request.end) if request.end else start_dt.replace(hour=23, minute=59, second=59, microsecond=999999)
 
-    # MongoDB query with better filters to avoid duplicates
-    query = {
-        "$and": [
-            {"Date.value": {"$gte": start_dt.strftime('%Y%m%d'), "$lte": end_dt.strftime('%Y%m%d')}},
-            {"Time.value": {"$gte": start_dt.strftime('%H%M%S'), "$lte": end_dt.strftime('%H%M%S')}}
-        ]
-    }
+    if request.interval:
+        weather_data = get_rollup_data(request, start_dt, end_dt)
+        if not weather_data:
+            raise HTTPException(status_code=404, detail="No data found for the given parameters and time range.")
+        return weather_data
 
-    # Make sure to sort the query to avoid any unordered results
-    results = collection_ws.find(query, sort=[("Date.value", pymongo.ASCENDING), ("Time.value", pymongo.ASCENDING)])
-    result_count = collection_ws.count_documents(query)
+    # Readings of the archive and of MongoDB between the datetimes of the station, sorted by time
+    results = find_readings(collection_ws, archive_path, start_dt, end_dt, archive_partition)
 
     # Avoid duplicate entries by keeping track of seen datetime values
     seen_datetimes = set()
     weather_data = []
 
     for doc in results:
-        date_str = doc["Date"]["value"]
-        time_str = doc["Time"]["value"]
-        datetime_str = f"{date_str} {time_str[:2]}:{time_str[2:4]}"
-        reading_datetime = datetime.strptime(datetime_str, "%Y%m%d %H:%M").replace(tzinfo=timezone.utc)
+        reading_datetime = doc["timestamp"].replace(second=0, microsecond=0, tzinfo=timezone.utc)
 
         # Skip duplicates based on DateTime
         if reading_datetime in seen_datetimes:
@@ -143,5 +149,6 @@ def get_help():
                    "  'end': '2025-03-25 23:59:59',\n"
                    "  'params': ['temp', 'hum'],\n"
                    "  'output': 'weather_data.csv'\n"
-                   "}"
+                   "}\n\n"
+                   "Add 'interval': '1min', '10min' or '1h' to get the mean, min and max of each interval, with the number of readings ('count')."
     }